@@ -0,0 +1,889 @@
+# bench_music_dsl.py - Micro-benchmarks for the Music DSL pipeline
+#
+# Usage: python bench_music_dsl.py [benchmark ...]
+# Run without arguments to list the available benchmarks.
+# Needs the packages in requirements-dev.txt (midiutil is the MIDI reference).
+
+import sys
+import time
+import io
+import contextlib
+import tracemalloc
+import tempfile
+import os
+import hashlib
+from typing import Any, Callable, List, Tuple
+from dataclasses import dataclass
+
+from midiutil import MIDIFile
+
+from music_dsl import (
+    Lexer, RegexLexer, Parser, IncrementalParser, save_ast_cache, load_ast_cache,
+    PianoNote, NoteEvent, Interpreter, SlotEnvironment, UNDEFINED, NoteRenderCache,
+    AUDIO_BLOCK_SAMPLES, encoder_command,
+)
+
+import numpy as np
+
+
+##############################
+# HELPERS
+##############################
+
+def generate_song(lines: int = 50000) -> str:
+    """Build a machine-generated four-track song of roughly `lines` lines"""
+    per_track = max(lines // 4, 8)
+    notes = ["C4", "D4", "E4", "F#4", "G4", "A4", "Bb4", "C5"]
+    drums = ["KICK", "HIHAT_CLOSED", "SNARE", "HIHAT_OPEN"]
+    parts: List[str] = ["// Generated benchmark song"]
+
+    parts.append("PianoTrack {")
+    parts.append("    Tempo = 120;")
+    parts.append('    Volume = "mf";')
+    for i in range(per_track):
+        parts.append(f"    Piano(R, {notes[i % len(notes)]}, 0.25);  // step {i}")
+    parts.append("}")
+
+    parts.append("GuitarTrack {")
+    parts.append("    f = 3;")
+    for i in range(per_track):
+        parts.append(f"    Guitar({i % 6 + 1}, {i % 12}, 1/4);")
+    parts.append("}")
+
+    parts.append("BassTrack {")
+    for i in range(per_track // 4):
+        parts.append(f"    for (i = 0; i < 2; i += 1) {{")
+        parts.append(f"        Bass({i % 4 + 1}, {i % 5}, 0.5);")
+        parts.append("    }")
+    parts.append("}")
+
+    parts.append("DrumTrack {")
+    for i in range(per_track // 3):
+        parts.append("    sync {")
+        parts.append(f"        Drum({drums[i % len(drums)]}, 0.25);")
+        parts.append("    }")
+    parts.append("}")
+
+    return "\n".join(parts) + "\n"
+
+
+def best_of(func: Callable[[], object], repeat: int = 5) -> float:
+    """Return the fastest of `repeat` runs of `func`, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(title: str, rows: List[Tuple[str, float]]) -> None:
+    print(f"\n{title}")
+    baseline = rows[0][1]
+    for name, seconds in rows:
+        print(f"  {name:<28} {seconds * 1000:10.2f} ms  ({baseline / seconds:5.2f}x)")
+
+
+##############################
+# BENCHMARKS
+##############################
+
+def bench_lexer() -> None:
+    """Character-at-a-time Lexer vs the master-regex RegexLexer"""
+    source = generate_song(50000)
+
+    reference = [(t.type, t.lexeme, t.literal, t.line) for t in Lexer(source).scan_tokens()]
+    fast = [(t.type, t.lexeme, t.literal, t.line) for t in RegexLexer(source).scan_tokens()]
+    assert reference == fast, "RegexLexer token stream differs from Lexer"
+
+    report(f"Lexing {source.count(chr(10))} lines ({len(reference)} tokens)", [
+        ("Lexer.scan_tokens", best_of(lambda: Lexer(source).scan_tokens(), 3)),
+        ("RegexLexer.scan_tokens", best_of(lambda: RegexLexer(source).scan_tokens(), 3)),
+    ])
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    """Return the peak traced allocation size while running `func`, in bytes"""
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_streaming() -> None:
+    """Token list + Parser vs tokens streamed through the lookahead buffer"""
+    source = generate_song(50000)
+
+    def eager() -> None:
+        Parser(RegexLexer(source).scan_tokens()).parse()
+
+    def lazy() -> None:
+        Parser(RegexLexer(source).iter_tokens()).parse()
+
+    def first_track_eager() -> None:
+        next(Parser(RegexLexer(source).scan_tokens()).iter_tracks())
+
+    def first_track_lazy() -> None:
+        next(Parser(RegexLexer(source).iter_tokens()).iter_tracks())
+
+    report("Lex + parse, full program", [
+        ("token list", best_of(eager, 3)),
+        ("streamed tokens", best_of(lazy, 3)),
+    ])
+    report("Time to first track", [
+        ("token list", best_of(first_track_eager, 3)),
+        ("streamed tokens", best_of(first_track_lazy, 3)),
+    ])
+    print("\nPeak memory, full program")
+    print(f"  token list                   {peak_memory(eager) / 2**20:10.1f} MB")
+    print(f"  streamed tokens              {peak_memory(lazy) / 2**20:10.1f} MB")
+
+
+def bench_incremental() -> None:
+    """Full re-parse vs IncrementalParser after editing only the drum track"""
+    source = generate_song(20000)
+    edited = source.replace("Drum(KICK, 0.25);", "Drum(CRASH, 0.25);")
+    assert edited != source
+
+    def full() -> None:
+        Parser(RegexLexer(edited).iter_tokens()).parse()
+
+    def incremental() -> None:
+        parser = IncrementalParser()
+        with contextlib.redirect_stdout(io.StringIO()):
+            parser.parse(source)  # Warm cache: the previous IDE run
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            parser.parse(edited)
+        timings.append(time.perf_counter() - start)
+
+    timings: List[float] = []
+    for _ in range(3):
+        incremental()
+
+    report("Re-parse after a drum-only edit", [
+        ("Parser.parse", best_of(full, 3)),
+        ("IncrementalParser.parse", min(timings)),
+    ])
+
+
+def bench_ast_cache() -> None:
+    """Fresh lex + parse vs loading the precompiled .mdslc AST"""
+    source = generate_song(20000)
+    tracks = Parser(RegexLexer(source).iter_tokens()).parse()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_file = os.path.join(temp_dir, "song.mdslc")
+        save_ast_cache(cache_file, source, tracks)
+        assert repr(load_ast_cache(cache_file, source)) == repr(tracks)
+
+        print(f"\nSource {len(source)} bytes, cache file {os.path.getsize(cache_file)} bytes")
+        report("Loading a 20k-line song", [
+            ("RegexLexer + Parser", best_of(lambda: Parser(RegexLexer(source).iter_tokens()).parse(), 3)),
+            ("load_ast_cache", best_of(lambda: load_ast_cache(cache_file, source), 3)),
+        ])
+
+
+# Dict-backed equivalents of the AST and event classes before __slots__
+@dataclass
+class DictPianoNote:
+    hand: str
+    note: Any
+    duration: Any
+
+class DictNoteEvent:
+    def __init__(self, start_time: float, duration: float, note_value: int, velocity: int, channel: int):
+        self.start_time = start_time
+        self.duration = duration
+        self.note_value = note_value
+        self.velocity = velocity
+        self.channel = channel
+
+
+def bench_node_memory() -> None:
+    """Bytes per note for dict-backed vs slotted AST and event objects"""
+    count = 200000
+
+    def per_note(factory: Callable[[int], object]) -> float:
+        tracemalloc.start()
+        try:
+            # Distinct float values, as the interpreter produces them
+            objects = [factory(i) for i in range(count)]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del objects
+        return size / count
+
+    print(f"\nMemory per note ({count} notes, including the list slot and float fields)")
+    rows = [
+        ("PianoNote (dict)", lambda i: DictPianoNote("R", "C4", i * 0.25)),
+        ("PianoNote (slots)", lambda i: PianoNote("R", "C4", i * 0.25)),
+        ("NoteEvent (dict)", lambda i: DictNoteEvent(i * 0.25, 0.25, 60, 80, 0)),
+        ("NoteEvent (slots)", lambda i: NoteEvent(i * 0.25, 0.25, 60, 80, 0)),
+    ]
+    for name, factory in rows:
+        print(f"  {name:<28} {per_note(factory):10.1f} bytes")
+
+
+def generate_loop_song(outer: int = 200) -> str:
+    """A loop-heavy song: nested for loops with variables and expressions"""
+    return f"""
+PianoTrack {{
+    Tempo = 120;
+    base = 60;
+    for (i = 0; i < {outer}; i++) {{
+        for (j = 0; j < 16; j += 1) {{
+            n = (base + j);
+            Piano(R, n, 0.125);
+            Piano(L, C3, 0.125);
+        }}
+    }}
+}}
+GuitarTrack {{
+    for (i = 0; i < {outer}; i++) {{
+        for (f = 0; f < 12; f++) {{
+            Guitar(2, f, 0.25);
+            sync {{
+                Guitar(1, 0, 0.25);
+                Guitar(3, 2, 0.25);
+            }}
+        }}
+    }}
+}}
+DrumTrack {{
+    for (i = 0; i < {outer}; i++) {{
+        for (k = 0; k < 8; k++) {{
+            Drum(KICK, 0.25);
+            Drum(HIHAT_CLOSED, 0.25);
+            Drum(SNARE, 0.25);
+            Drum(HIHAT_CLOSED, 0.25);
+        }}
+    }}
+}}
+"""
+
+
+def event_tuples(interpreter: Interpreter) -> List[Tuple[Any, ...]]:
+    return [
+        (type(e).__name__, e.start_time, e.duration,
+         getattr(e, "note_value", None), getattr(e, "velocity", None), getattr(e, "channel", None))
+        for e in interpreter.events
+    ]
+
+
+def interpret(tracks: List[Any], **options: Any) -> Interpreter:
+    interpreter = Interpreter(**options)
+    interpreter.interpret(tracks)
+    return interpreter
+
+
+def bench_compiler() -> None:
+    """Tree-walking execute_command vs TrackCompiler closures"""
+    tracks = Parser(RegexLexer(generate_loop_song()).iter_tokens()).parse()
+    reference = interpret(tracks, compiled=False, optimize=False)
+    compiled = interpret(tracks, compiled=True, optimize=False)
+    assert event_tuples(reference) == event_tuples(compiled), "Compiled events differ"
+
+    report(f"Interpreting a loop-heavy song ({len(reference.events)} events)", [
+        ("execute_command", best_of(lambda: interpret(tracks, compiled=False, optimize=False), 3)),
+        ("TrackCompiler closures", best_of(lambda: interpret(tracks, compiled=True, optimize=False), 3)),
+    ])
+
+
+def bench_optimizer() -> None:
+    """Interpretation with and without the AstOptimizer pass"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_loop_song()).iter_tokens()).parse()
+    reference = interpret(tracks, compiled=False, optimize=False)
+    for options in ({"compiled": False}, {}):
+        assert event_tuples(interpret(tracks, **options)) == event_tuples(reference), "Optimized events differ"
+
+    report("Tree walker (execute_command)", [
+        ("unoptimized", best_of(lambda: interpret(tracks, compiled=False, optimize=False), 3)),
+        ("optimized", best_of(lambda: interpret(tracks, compiled=False), 3)),
+    ])
+    report("Compiled closures", [
+        ("unoptimized", best_of(lambda: interpret(tracks, optimize=False), 3)),
+        ("optimized", best_of(lambda: interpret(tracks), 3)),
+    ])
+
+
+def bench_parallel() -> None:
+    """Serial interpret vs interpret_parallel across a process pool"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_loop_song(800)).iter_tokens()).parse()
+    serial = interpret(tracks)
+    parallel = Interpreter()
+    parallel.interpret_parallel(tracks)
+    assert event_tuples(serial) == event_tuples(parallel), "Parallel events differ"
+
+    def run_parallel() -> None:
+        Interpreter().interpret_parallel(tracks)
+
+    report(f"Interpreting {len(tracks)} loop-heavy tracks ({len(serial.events)} events)", [
+        ("interpret", best_of(lambda: interpret(tracks), 3)),
+        ("interpret_parallel", best_of(run_parallel, 3)),
+    ])
+
+
+def generate_ostinato_song(bars: int = 400) -> str:
+    """Drum and bass loops whose bodies never read the loop variable"""
+    return f"""
+DrumTrack {{
+    for (i = 0; i < {bars}; i++) {{
+        sync {{ Drum(KICK, 0.25); Drum(CRASH, 0.5); }}
+        Drum(HIHAT_CLOSED, 0.25);
+        Drum(SNARE, 0.25);
+        Drum(HIHAT_CLOSED, 0.25);
+    }}
+}}
+BassTrack {{
+    root = 3;
+    for (i = 0; i < {bars}; i++) {{
+        Bass(1, root, 0.5);
+        Bass(1, 5, 0.25);
+        Bass(2, 2, 0.25);
+    }}
+}}
+"""
+
+
+def bench_replication() -> None:
+    """Compiled loops re-running their body vs time-shifted body copies"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_ostinato_song(999)).iter_tokens()).parse()
+    reference = interpret(tracks, compiled=False)
+    replicated = interpret(tracks)
+    assert event_tuples(reference) == event_tuples(replicated), "Replicated events differ"
+
+    report(f"Interpreting ostinato loops ({len(reference.events)} events)", [
+        ("re-run body", best_of(lambda: interpret(tracks, replicate_loops=False), 5)),
+        ("replicated body", best_of(lambda: interpret(tracks), 5)),
+    ])
+
+
+def bench_variables() -> None:
+    """Dict lookups vs slot-indexed reads of compiled variables"""
+    environment = SlotEnvironment()
+    names = [f"v{i}" for i in range(16)]
+    for i, name in enumerate(names):
+        environment.define(name, i)
+    values = environment.values
+    slots = environment.slots
+    indices = [environment.slot(name) for name in names]
+
+    def dict_reads() -> None:
+        for _ in range(20000):
+            for name in names:
+                if name in values:
+                    values[name]
+
+    def slot_reads() -> None:
+        for _ in range(20000):
+            for index in indices:
+                if slots[index] is not UNDEFINED:
+                    pass
+
+    report("320k variable reads", [
+        ("name in values; values[name]", best_of(dict_reads, 3)),
+        ("slots[index] is not UNDEFINED", best_of(slot_reads, 3)),
+    ])
+
+
+def bench_tempo_map() -> None:
+    """Per-note seconds -> beats calls vs one vectorized TempoMap pass"""
+    lines = ["PianoTrack {"]
+    for i in range(2000):
+        lines.append(f"    Tempo = {90 + i % 60};")
+        for note in ("C4", "E4", "G4", "C5"):
+            lines.append(f"    Piano(R, {note}, 0.25);")
+    lines.append("}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer("\n".join(lines)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    events = interpreter.events
+    notes = events.note_indices()
+    starts, durations = events.start[notes], events.duration[notes]
+
+    def per_note() -> None:
+        tempo_map = interpreter.tempo_map()
+        for start, duration in zip(starts.tolist(), durations.tolist()):
+            tempo_map.time_to_beats(start)
+            tempo_map.duration_to_beats(duration, start)
+
+    def vectorized() -> None:
+        tempo_map = interpreter.tempo_map()
+        tempo_map.times_to_beats(starts)
+        tempo_map.durations_to_beats(durations, starts)
+
+    report(f"Converting {len(notes)} notes across {len(interpreter.tempo_map())} tempo segments", [
+        ("per-note bisect", best_of(per_note, 3)),
+        ("vectorized searchsorted", best_of(vectorized, 3)),
+    ])
+
+
+def bench_iter_events() -> None:
+    """Eager interpret + sort vs the lazy iter_events merge"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_loop_song(999)).iter_tokens()).parse()
+
+    def eager() -> None:
+        interpreter = interpret(tracks)
+        for _ in interpreter.events.events_at(interpreter.events.sorted_indices()):
+            pass
+
+    def lazy() -> None:
+        for _ in Interpreter().iter_events(tracks):
+            pass
+
+    def first_event_eager() -> None:
+        interpreter = interpret(tracks)
+        interpreter.events.events_at(interpreter.events.sorted_indices()[:1])
+
+    def first_event_lazy() -> None:
+        next(Interpreter().iter_events(tracks))
+
+    report("Interpret and consume every event in time order", [
+        ("interpret + sort", best_of(eager, 3)),
+        ("iter_events", best_of(lazy, 3)),
+    ])
+    report("Time to first event", [
+        ("interpret + sort", best_of(first_event_eager, 3)),
+        ("iter_events", best_of(first_event_lazy, 3)),
+    ])
+    print("\nPeak memory")
+    print(f"  interpret + sort             {peak_memory(eager) / 2**20:10.1f} MB")
+    print(f"  iter_events                  {peak_memory(lazy) / 2**20:10.1f} MB")
+
+
+def midiutil_bytes(interpreter: Interpreter) -> bytes:
+    """generate_midi as it was written against midiutil, for comparison"""
+    midi = MIDIFile(4)
+    for track, channel, program in ((0, 0, 0), (1, 1, 24), (2, 2, 33)):
+        midi.addProgramChange(track, channel, 0, program)
+    tempo_map = interpreter.tempo_map()
+    for tempo_event in interpreter.tempo_events:
+        midi.addTempo(0, tempo_map.time_to_beats(tempo_event.time), tempo_event.tempo)
+    if not interpreter.tempo_events:
+        midi.addTempo(0, 0, 120)
+
+    events = interpreter.events
+    notes = events.note_indices()
+    for start, duration, pitch, velocity, channel in zip(
+            events.start[notes].tolist(), events.duration[notes].tolist(), events.pitch_values(notes),
+            events.velocity[notes].tolist(), events.channel[notes].tolist()):
+        duration_beats = tempo_map.duration_to_beats(duration, start)
+        midi.addNote(3 if channel == 9 else channel, channel, pitch, tempo_map.time_to_beats(start),
+                     duration_beats if duration_beats > 0 else 0.25, velocity)
+
+    output = io.BytesIO()
+    midi.writeFile(output)
+    return output.getvalue()
+
+
+def decode_smf(data: bytes) -> List[List[Tuple[int, ...]]]:
+    """Decode an SMF into per-track (absolute tick, status, data...) events, expanding running status"""
+    assert data[:4] == b"MThd"
+    num_tracks = int.from_bytes(data[10:12], "big")
+    position = 14
+    tracks = []
+    for _ in range(num_tracks):
+        assert data[position:position + 4] == b"MTrk"
+        end = position + 8 + int.from_bytes(data[position + 4:position + 8], "big")
+        position += 8
+        tick, status, decoded = 0, 0, []
+        while position < end:
+            delta = 0
+            while True:
+                byte = data[position]
+                position += 1
+                delta = (delta << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            tick += delta
+            if data[position] >= 0x80:
+                status = data[position]
+                position += 1
+            if status == 0xFF:
+                kind, length = data[position], data[position + 1]
+                decoded.append((tick, status, kind, data[position + 2:position + 2 + length]))
+                position += 2 + length
+                status = 0  # Meta events cancel running status
+            else:
+                size = 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+                decoded.append((tick, status, *data[position:position + size]))
+                position += size
+        tracks.append(decoded)
+    return tracks
+
+
+def bench_midi_writer() -> None:
+    """midiutil MIDIFile vs the native MidiWriter on a 100k-note song"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_song(141200)).iter_tokens()).parse()
+        interpreter = interpret(tracks)
+    notes = len(interpreter.events.note_indices())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        native_file = os.path.join(temp_dir, "native.mid")
+        with contextlib.redirect_stdout(io.StringIO()):
+            interpreter.generate_midi(native_file)
+        with open(native_file, "rb") as f:
+            native = f.read()
+        reference = midiutil_bytes(interpreter)
+        assert decode_smf(native) == decode_smf(reference), "Decoded MIDI events differ from midiutil"
+
+        print(f"\nDecoded events identical; file size {len(reference)} -> {len(native)} bytes")
+        report(f"Writing {notes} notes", [
+            ("midiutil MIDIFile", best_of(lambda: midiutil_bytes(interpreter), 3)),
+            ("MidiWriter", best_of(lambda: interpreter.generate_midi(native_file), 3)),
+        ])
+
+
+def synthesize(interpreter: Interpreter, wav_file: str, cache: NoteRenderCache) -> bytes:
+    """Render with the given note cache"""
+    interpreter.note_cache = cache
+    interpreter.synthesize_basic_wav(wav_file)
+    with open(wav_file, "rb") as f:
+        return f.read()
+
+
+def bench_note_cache() -> None:
+    """Rendering every note vs the NoteRenderCache in synthesize_basic_wav"""
+    songs = [(name, open(name).read()) for name in ("mysong.txt", "spacemusic.txt")]
+    songs.append(("generated ostinato song", generate_ostinato_song(50)))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        for name, source in songs:
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracks = Parser(RegexLexer(source).iter_tokens()).parse()
+            interpreter = interpret(tracks)
+            notes = len(interpreter.events.note_indices())
+            if not notes:
+                print(f"\n{name}: no notes to render, skipped")
+                continue
+
+            cache = NoteRenderCache()
+            cached = synthesize(interpreter, wav_file, cache)
+            uncached = synthesize(interpreter, wav_file, NoteRenderCache(max_entries=0))
+            assert cached == uncached, f"Cached rendering of {name} differs"
+
+            print(f"\n{name}: hit rate {cache.hit_rate:.1%}, {len(cache.cache)} buffers, "
+                  f"{cache.nbytes / 1024 / 1024:.1f} MB cached")
+            report(f"Synthesizing {name} ({notes} notes)", [
+                ("render every note", best_of(
+                    lambda: synthesize(interpreter, wav_file, NoteRenderCache(max_entries=0)), 3)),
+                ("note render cache", best_of(
+                    lambda: synthesize(interpreter, wav_file, NoteRenderCache()), 3)),
+            ])
+
+
+def generate_sustained_song(notes: int = 40) -> str:
+    """Build a three-track song of long held notes, all different"""
+    parts: List[str] = ["// Generated sustained-note benchmark song"]
+    for track, note in (("PianoTrack", "Piano(R, {spn}, 4);"),
+                        ("GuitarTrack", "Guitar({string}, {fret}, 4);"),
+                        ("BassTrack", "Bass({string}, {fret}, 4);")):
+        parts.append(track + " {")
+        for i in range(notes):
+            spn = ["C", "D", "E", "F", "G", "A", "B"][i % 7] + str(3 + i // 7 % 3)
+            parts.append("    " + note.format(spn=spn, string=i % 4 + 1, fret=i % 12))
+        parts.append("}")
+    return "\n".join(parts) + "\n"
+
+
+def bench_wavetable() -> None:
+    """Additive np.sin synthesis vs wavetable lookup on long sustained notes"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_sustained_song()).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    notes = len(interpreter.events.note_indices())
+
+    def synthesize_mode(synthesis: str) -> bytes:
+        interpreter.synthesis = synthesis
+        return synthesize(interpreter, wav_file, NoteRenderCache(max_entries=0))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        additive = np.frombuffer(synthesize_mode("additive")[44:], dtype=np.int16)
+        wavetable = np.frombuffer(synthesize_mode("wavetable")[44:], dtype=np.int16)
+        error = np.abs(additive.astype(np.int32) - wavetable).max()
+        print(f"\nLargest sample difference: {error} of 32767")
+
+        report(f"Synthesizing {notes} sustained notes", [
+            ("additive sines", best_of(lambda: synthesize_mode("additive"), 3)),
+            ("wavetable", best_of(lambda: synthesize_mode("wavetable"), 3)),
+        ])
+
+
+def bench_block_renderer() -> None:
+    """Peak memory of one whole-song audio block vs the streaming block renderer"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_ostinato_song(960)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    sample_count = interpreter.audio_sample_count()
+
+    def render(block_samples: int) -> None:
+        # Without the note cache, whose own budget would dominate the streaming peak
+        interpreter.note_cache = NoteRenderCache(max_entries=0)
+        interpreter.synthesize_basic_wav(wav_file, block_samples)
+    whole_song = lambda: render(sample_count)
+    streaming = lambda: render(AUDIO_BLOCK_SAMPLES)
+
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        digests = []
+        for func in (whole_song, streaming):
+            func()
+            with open(wav_file, "rb") as f:
+                digests.append(hashlib.sha1(f.read()).hexdigest())
+        assert digests[0] == digests[1], "Streamed audio differs"
+
+        print(f"\nSynthesizing {sample_count / 44100 / 60:.0f} minutes of audio ({len(interpreter.events)} events)")
+        for name, func in (("one whole-song block", whole_song), ("streaming blocks", streaming)):
+            print(f"  {name:<28} {peak_memory(func) / 1024 / 1024:10.1f} MB peak")
+        report("Synthesis time", [
+            ("one whole-song block", best_of(whole_song, 3)),
+            ("streaming blocks", best_of(streaming, 3)),
+        ])
+
+
+def bench_parallel_render() -> None:
+    """Serial block renderer vs time shards mixed across a process pool"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_sustained_song(150)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    workers = os.cpu_count() or 1
+
+    def render(render_workers: int) -> None:
+        interpreter.render_workers = render_workers
+        interpreter.note_cache = NoteRenderCache()
+        interpreter.synthesize_basic_wav(wav_file)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        digests = []
+        for render_workers in (1, max(workers, 2)):
+            render(render_workers)
+            with open(wav_file, "rb") as f:
+                digests.append(hashlib.sha1(f.read()).hexdigest())
+        assert digests[0] == digests[1], "Sharded audio differs"
+
+        seconds = interpreter.audio_sample_count() / 44100
+        report(f"Synthesizing {seconds:.0f} s of sustained notes on {workers} CPU(s)", [
+            ("serial blocks", best_of(lambda: render(1), 3)),
+            (f"{max(workers, 2)} shard workers", best_of(lambda: render(max(workers, 2)), 3)),
+        ])
+
+
+def bench_mp3_pipeline() -> None:
+    """Temp WAV + pydub decode/normalize/gain vs mastered PCM handed over in memory"""
+    import shutil
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        from pydub import AudioSegment
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_ostinato_song(240)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    # Without ffmpeg/lame, time pydub's WAV export as the stand-in encoder
+    encoding = "mp3" if shutil.which("ffmpeg") else "wav"
+
+    def timed(stages: List[Tuple[str, Callable[[], Any]]]) -> List[Tuple[str, float]]:
+        times = []
+        for name, func in stages:
+            started = time.perf_counter()
+            func()
+            times.append((name, time.perf_counter() - started))
+        return times
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        state: dict = {}
+        before = timed([
+            ("synthesize to temp WAV", lambda: interpreter.synthesize_basic_wav(wav_file)),
+            ("decode WAV", lambda: state.update(audio=AudioSegment.from_file(wav_file, format="wav"))),
+            ("normalize", lambda: state.update(audio=state["audio"].normalize())),
+            ("+6 dB gain", lambda: state.update(audio=state["audio"] + 6)),
+            (f"export {encoding}", lambda: state["audio"].export(io.BytesIO(), format=encoding)),
+        ])
+        reference = state["audio"].raw_data
+
+        after = timed([
+            ("synthesize mastered PCM", lambda: state.update(pcm=interpreter.synthesize_pcm(master=True))),
+            ("wrap PCM", lambda: state.update(audio=AudioSegment(
+                data=state["pcm"], sample_width=2, frame_rate=44100, channels=1))),
+            (f"export {encoding}", lambda: state["audio"].export(io.BytesIO(), format=encoding)),
+        ])
+        assert state["pcm"] == reference, "Mastered PCM differs from pydub normalize + gain"
+
+    seconds = interpreter.audio_sample_count() / 44100
+    for title, stages in ((f"Before: temp WAV + pydub ({seconds:.0f} s of audio)", before),
+                          ("After: in-memory mastered PCM", after)):
+        print(f"\n{title}")
+        for name, elapsed in stages:
+            print(f"  {name:<28} {elapsed * 1000:10.2f} ms")
+        print(f"  {'total':<28} {sum(elapsed for _, elapsed in stages) * 1000:10.2f} ms")
+
+
+def bench_streaming_encoder() -> None:
+    """Render everything, then encode vs piping blocks to the encoder as they render"""
+    import subprocess
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_ostinato_song(240)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    # Without ffmpeg/lame, gzip stands in as a CPU-bound stream encoder
+    command = encoder_command() or ["gzip", "-6", "-c"]
+
+    def back_to_back() -> None:
+        pcm = interpreter.synthesize_pcm(master=True)
+        subprocess.run(command, input=pcm, stdout=subprocess.PIPE, check=True)
+
+    def streamed() -> None:
+        interpreter.encode_mp3(io.BytesIO(), command)
+
+    print(f"\nEncoder: {os.path.basename(command[0])}")
+    report(f"Synthesizing and encoding {interpreter.audio_sample_count() / 44100:.0f} s of audio", [
+        ("render, then encode", best_of(back_to_back, 3)),
+        ("streaming encoder", best_of(streamed, 3)),
+    ])
+
+
+def bench_limiter() -> None:
+    """Two-pass peak normalization vs the single-pass LookaheadLimiter"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_ostinato_song(480)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+
+    def first_block(normalize: str) -> None:
+        interpreter.normalize = normalize
+        next(iter(interpreter.iter_audio_blocks()))
+
+    def whole_song(normalize: str) -> np.ndarray:
+        interpreter.normalize = normalize
+        return np.frombuffer(interpreter.synthesize_pcm(), dtype=np.int16).astype(np.float64)
+
+    peak, limited = whole_song("peak"), whole_song("limiter")
+    assert len(peak) == len(limited), "Limiter changed the song length"
+    rms = lambda samples: np.sqrt(np.mean(samples ** 2))
+    print(f"\nPeak sample {int(np.abs(peak).max())} vs {int(np.abs(limited).max())}, "
+          f"loudness difference {20 * np.log10(rms(limited) / rms(peak)):+.1f} dB")
+
+    seconds = interpreter.audio_sample_count() / 44100
+    report(f"First block of {seconds:.0f} s of audio", [
+        ("peak normalize", best_of(lambda: first_block("peak"), 3)),
+        ("lookahead limiter", best_of(lambda: first_block("limiter"), 3)),
+    ])
+    report("Whole song", [
+        ("peak normalize", best_of(lambda: whole_song("peak"), 3)),
+        ("lookahead limiter", best_of(lambda: whole_song("limiter"), 3)),
+    ])
+
+
+def generate_drum_song(bars: int = 400) -> str:
+    """A drum track with 16th-note hi-hats over kick and snare"""
+    return f"""
+DrumTrack {{
+    for (i = 0; i < {bars}; i++) {{
+        sync {{ Drum(KICK, 0.25); Drum(HIHAT_CLOSED, 0.25); }}
+        Drum(HIHAT_CLOSED, 0.25);
+        sync {{ Drum(SNARE, 0.25); Drum(HIHAT_CLOSED, 0.25); }}
+        Drum(HIHAT_OPEN, 0.25);
+    }}
+}}
+"""
+
+
+def bench_drum_cache() -> None:
+    """Rendering every drum hit vs seeded noise tables and the drum hit cache"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_drum_song()).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+    hits = len(interpreter.events.note_indices())
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        wav_file = os.path.join(temp_dir, "song.wav")
+        cache = NoteRenderCache()
+        cached = synthesize(interpreter, wav_file, cache)
+        assert cached == synthesize(interpreter, wav_file, NoteRenderCache(max_entries=0)), \
+            "Drum renders are not deterministic"
+
+        print(f"\nDrum hits are deterministic; hit rate {cache.hit_rate:.1%}, {len(cache.cache)} buffers")
+        report(f"Synthesizing {hits} drum hits", [
+            ("render every hit", best_of(
+                lambda: synthesize(interpreter, wav_file, NoteRenderCache(max_entries=0)), 3)),
+            ("drum hit cache", best_of(
+                lambda: synthesize(interpreter, wav_file, NoteRenderCache()), 3)),
+        ])
+
+
+def bench_profiles() -> None:
+    """The final render profile vs the fast preview profile"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks = Parser(RegexLexer(generate_song(2000)).iter_tokens()).parse()
+    interpreter = interpret(tracks)
+
+    def render(profile: str) -> None:
+        interpreter.note_cache = NoteRenderCache()
+        interpreter.synthesize_pcm(master=True, profile=interpreter.resolve_profile(profile))
+
+    seconds = interpreter.audio_sample_count() / 44100
+    report(f"Rendering {seconds:.0f} s of audio ({len(interpreter.events.note_indices())} notes)", [
+        ("final (44.1 kHz, harmonics)", best_of(lambda: render("final"), 3)),
+        ("preview (22.05 kHz, sine)", best_of(lambda: render("preview"), 3)),
+    ])
+
+
+BENCHMARKS = {
+    "lexer": bench_lexer,
+    "streaming": bench_streaming,
+    "incremental": bench_incremental,
+    "ast_cache": bench_ast_cache,
+    "node_memory": bench_node_memory,
+    "compiler": bench_compiler,
+    "optimizer": bench_optimizer,
+    "parallel": bench_parallel,
+    "replication": bench_replication,
+    "variables": bench_variables,
+    "tempo_map": bench_tempo_map,
+    "iter_events": bench_iter_events,
+    "midi_writer": bench_midi_writer,
+    "note_cache": bench_note_cache,
+    "wavetable": bench_wavetable,
+    "block_renderer": bench_block_renderer,
+    "parallel_render": bench_parallel_render,
+    "mp3_pipeline": bench_mp3_pipeline,
+    "streaming_encoder": bench_streaming_encoder,
+    "limiter": bench_limiter,
+    "drum_cache": bench_drum_cache,
+    "profiles": bench_profiles,
+}
+
+
+def main() -> None:
+    names = sys.argv[1:]
+    if not names:
+        print("Usage: python bench_music_dsl.py <benchmark> [...] | all")
+        for name, func in BENCHMARKS.items():
+            print(f"  {name:<18} {func.__doc__}")
+        return
+
+    if names == ["all"]:
+        names = list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}")
+            continue
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,49 @@ from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import tempfile
 import os
+import io
 import json
-from music_dsl import Lexer, Parser, Interpreter  # Import your existing classes
+from music_dsl import (  # Import your existing classes
+    IncrementalParser, Interpreter, ExecutionBudget, BudgetExceededError, NoteRenderCache,
+    RENDER_PROFILES,
+)
 import uuid
 from datetime import datetime
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for cross-origin requests
 
+# Per-request interpretation limits, so one runaway program (e.g. three
+# nested 1000-iteration loops) cannot tie up the server. None disables a limit.
+app.config.setdefault('DSL_MAX_COMMANDS', 2_000_000)
+app.config.setdefault('DSL_MAX_EVENTS', 200_000)
+app.config.setdefault('DSL_MAX_SECONDS', 30 * 60)  # Length of the rendered song
+app.config.setdefault('DSL_MAX_WALL_SECONDS', 10.0)  # Interpretation deadline
+
+# Processes that synthesize audio time shards in parallel. Each render with
+# more than 1 starts its own process pool (forked from this multithreaded
+# server) and skips the shared note cache, so only raise this on a dedicated
+# multi-core render host.
+app.config.setdefault('DSL_RENDER_WORKERS', 1)
+
+def execution_budget():
+    """A fresh ExecutionBudget from the server configuration"""
+    return ExecutionBudget(
+        max_commands=app.config['DSL_MAX_COMMANDS'],
+        max_events=app.config['DSL_MAX_EVENTS'],
+        max_seconds=app.config['DSL_MAX_SECONDS'],
+        max_wall_seconds=app.config['DSL_MAX_WALL_SECONDS'],
+    )
+
 # Store generated files temporarily
 generated_files = {}
 
+# Parsed tracks shared across requests; unchanged tracks are not re-parsed
+incremental_parser = IncrementalParser()
+
+# Rendered note buffers shared across requests
+note_cache = NoteRenderCache()
+
 @app.route('/')
 def index():
     return '''
@@ -22,7 +54,7 @@ def index():
     <p>Server is running! Use the web IDE to generate music.</p>
     <p>Endpoints:</p>
     <ul>
-        <li>POST /generate - Generate music from DSL code</li>
+        <li>POST /generate - Generate music from DSL code (optional profile: preview or final)</li>
         <li>GET /download/&lt;file_id&gt;/&lt;type&gt; - Download generated files</li>
     </ul>
     '''
@@ -38,6 +70,12 @@ def generate_music():
         dsl_code = data['code']
         print(f"Received DSL code: {len(dsl_code)} characters")
         
+        # Audio quality: 'preview' renders fast for IDE runs, 'final' for export
+        profile = data.get('profile', 'final')
+        if not isinstance(profile, str) or profile not in RENDER_PROFILES:
+            return jsonify({'error': f"Unknown profile: {profile}",
+                            'profiles': list(RENDER_PROFILES)}), 400
+        
         # Generate unique ID for this session
         session_id = str(uuid.uuid4())[:8]
         
@@ -51,13 +89,11 @@ def generate_music():
                 f.write(dsl_code)
             
             # Process the DSL code
-            print("Tokenizing source code...")
-            lexer = Lexer(dsl_code)
-            tokens = lexer.scan_tokens()
+            print("Tokenizing and parsing source code...")
+            tracks, had_error = incremental_parser.parse(dsl_code)
             
-            print("Parsing tokens into AST...")
-            parser = Parser(tokens)
-            tracks = parser.parse()
+            if had_error:
+                print("Parsing had errors but will continue with interpretation.")
             
             if not tracks:
                 return jsonify({'error': 'No valid tracks found in the code'}), 400
@@ -66,21 +102,22 @@ def generate_music():
             
             # Create interpreter and interpret AST
             print("Interpreting the music...")
-            interpreter = Interpreter()
+            interpreter = Interpreter(budget=execution_budget(), note_cache=note_cache,
+                                      render_workers=app.config['DSL_RENDER_WORKERS'])
             interpreter.interpret(tracks)
             
             # Generate files
             base_filename = os.path.join(temp_dir, 'generated_music')
             
-            # Generate MIDI file
+            # Generate MIDI data; it is small, so keep it in memory
             print("Generating MIDI file...")
-            midi_file = base_filename + '.mid'
-            interpreter.generate_midi(midi_file)
+            midi_data = interpreter.midi_bytes()
             
             # Generate MP3 file
             print("Generating MP3 file...")
             mp3_file = base_filename + '.mp3'
-            interpreter.convert_midi_to_mp3(midi_file, mp3_file)
+            # The MIDI data is in memory only, so there is no MIDI file to name
+            interpreter.convert_midi_to_mp3(None, mp3_file, profile=profile)
             
             # Generate sheet music data
             print("Generating sheet music...")
@@ -96,7 +133,7 @@ def generate_music():
             
             # Store file paths
             generated_files[session_id] = {
-                'midi': midi_file if os.path.exists(midi_file) else None,
+                'midi': midi_data,
                 'mp3': mp3_file if os.path.exists(mp3_file) else None,
                 'sheet_html': sheet_html if os.path.exists(sheet_html) else None,
                 'sheet_json': sheet_json if os.path.exists(sheet_json) else None,
@@ -110,8 +147,8 @@ def generate_music():
                 'session_id': session_id,
                 'tracks_count': len(tracks),
                 'events_count': len(interpreter.events),
-                'duration': max((event.start_time + event.duration for event in interpreter.events 
-                               if hasattr(event, 'start_time')), default=0),
+                'duration': interpreter.events.end_time(),
+                'profile': profile,
                 'files': {
                     'midi': f'/download/{session_id}/midi',
                     'mp3': f'/download/{session_id}/mp3',
@@ -123,6 +160,10 @@ def generate_music():
             print(f"Generation completed successfully! Session ID: {session_id}")
             return jsonify(response_data)
             
+        except BudgetExceededError as e:
+            print(f"Interpretation aborted: {e}")
+            return jsonify({**e.to_dict(), 'session_id': session_id}), 422
+            
         except Exception as e:
             print(f"Error during music generation: {e}")
             import traceback
@@ -146,7 +187,7 @@ def download_file(session_id, file_type):
         
         if file_type == 'midi' and files['midi']:
             return send_file(
-                files['midi'],
+                io.BytesIO(files['midi']),
                 as_attachment=True,
                 download_name='generated_music.mid',
                 mimetype='audio/midi'
@@ -222,6 +263,11 @@ def status():
     return jsonify({
         'status': 'running',
         'active_sessions': len(generated_files),
+        'note_cache': {
+            'entries': len(note_cache.cache),
+            'bytes': note_cache.nbytes,
+            'hit_rate': note_cache.hit_rate
+        },
         'sessions': {
             session_id: {
                 'created_at': data['created_at'],
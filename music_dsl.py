@@ -1,14 +1,27 @@
 import re
 from enum import Enum, auto
-from dataclasses import dataclass
-from typing import List, Any, Optional, Dict, Tuple, Union, cast
+from dataclasses import dataclass, fields
+from typing import List, Any, Optional, Dict, Tuple, Union, Iterable, Iterator, Callable, BinaryIO, cast
+from itertools import islice
+from collections import OrderedDict
 import os
 import tempfile
-from midiutil import MIDIFile
 import numpy as np
 import sys
 import wave
 import json
+import hashlib
+import marshal
+import zlib
+import threading
+import subprocess
+import shutil
+import time
+import math
+import operator
+import heapq
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 
 ##############################
 # LEXER
@@ -74,6 +87,7 @@ class TokenType(Enum):
 
 @dataclass
 class Token:
+    __slots__ = ("type", "lexeme", "literal", "line")
     type: TokenType
     lexeme: str
     literal: Any
@@ -86,6 +100,8 @@ class Lexer:
         self.start = 0
         self.current = 0
         self.line = 1
+        # Set when a character or string could not be tokenized (it is skipped)
+        self.had_error = False
         
         # Keywords mapping
         self.keywords: Dict[str, TokenType] = {
@@ -193,6 +209,7 @@ class Lexer:
                 self.add_token(TokenType.NOT_EQUAL)
             else:
                 # Handle error: unexpected character
+                self.had_error = True
                 print(f"Unexpected character at line {self.line}: {c}")
         # Skip whitespace
         elif c in [' ', '\r', '\t']:
@@ -210,6 +227,7 @@ class Lexer:
             self.identifier()
         else:
             # Handle error: unexpected character
+            self.had_error = True
             print(f"Unexpected character at line {self.line}: {c}")
     
     def advance(self) -> str:
@@ -244,6 +262,7 @@ class Lexer:
             
         if self.is_at_end():
             # Handle error: unterminated string
+            self.had_error = True
             print(f"Unterminated string at line {self.line}")
             return
             
@@ -306,94 +325,236 @@ class Lexer:
         self.tokens.append(Token(token_type, text, literal, self.line))
 
 
+class RegexLexer(Lexer):
+    """Single-pass lexer driven by one precompiled master regex.
+
+    Emits exactly the same token stream as Lexer (types, lexemes, literals
+    and line numbers), but lets the regex engine find each lexeme instead of
+    stepping through the source with advance()/peek()/match().
+    """
+
+    # Operators and punctuation, two-character lexemes first
+    OPERATORS: Dict[str, TokenType] = {
+        "++": TokenType.PLUS_PLUS,
+        "+=": TokenType.PLUS_EQUAL,
+        "--": TokenType.MINUS_MINUS,
+        "-=": TokenType.MINUS_EQUAL,
+        "*=": TokenType.MULTIPLY_EQUAL,
+        "/=": TokenType.DIVIDE_EQUAL,
+        "==": TokenType.EQUAL_EQUAL,
+        "<=": TokenType.LESS_EQUAL,
+        ">=": TokenType.GREATER_EQUAL,
+        "!=": TokenType.NOT_EQUAL,
+        "+": TokenType.PLUS,
+        "-": TokenType.MINUS,
+        "*": TokenType.MULTIPLY,
+        "/": TokenType.DIVIDE,
+        "=": TokenType.EQUALS,
+        "<": TokenType.LESS_THAN,
+        ">": TokenType.GREATER_THAN,
+        "(": TokenType.LEFT_PAREN,
+        ")": TokenType.RIGHT_PAREN,
+        "{": TokenType.LEFT_BRACE,
+        "}": TokenType.RIGHT_BRACE,
+        ",": TokenType.COMMA,
+        ";": TokenType.SEMICOLON,
+    }
+
+    # Compiled once and shared by every instance
+    master_pattern: Optional["re.Pattern[str]"] = None
+
+    def __init__(self, source: str):
+        super().__init__(source)
+        if RegexLexer.master_pattern is None:
+            RegexLexer.master_pattern = self.build_master_pattern()
+
+    def build_master_pattern(self) -> "re.Pattern[str]":
+        operators = "|".join(re.escape(op) for op in self.OPERATORS)
+        # Alternatives are tried in order, so floats come before ints and
+        # SPN notes before plain identifiers (same precedence as Lexer)
+        return re.compile("|".join([
+            r"(?P<NEWLINE>\n)",
+            r"(?P<WHITESPACE>[ \r\t]+)",
+            r"(?P<COMMENT>//[^\n]*)",
+            r'(?P<STRING>"[^"]*")',
+            r'(?P<UNTERMINATED>"[^"]*)',
+            r"(?P<FLOAT>\d+\.\d+)",
+            r"(?P<INT>\d+)",
+            rf"(?P<SPN>{self.note_pattern.pattern})(?!\w)",
+            r"(?P<IDENTIFIER>[^\W\d]\w*)",
+            rf"(?P<OPERATOR>{operators})",
+            r"(?P<ERROR>.)",
+        ]))
+
+    def scan_tokens(self) -> List[Token]:
+        self.tokens.extend(self.iter_tokens())
+        return self.tokens
+
+    def iter_tokens(self) -> Iterator[Token]:
+        """Lazily yield tokens (ending with EOF) without building self.tokens"""
+        keywords = self.keywords
+        operators = self.OPERATORS
+        source = self.source
+        end = len(source)
+        match = self.master_pattern.match
+        line = self.line
+        pos = 0
+
+        while pos < end:
+            m = match(source, pos)
+            kind = m.lastgroup
+            text = m.group()
+            pos = m.end()
+
+            if kind == "WHITESPACE" or kind == "COMMENT":
+                continue
+            elif kind == "NEWLINE":
+                line += 1
+            elif kind == "OPERATOR":
+                yield Token(operators[text], text, None, line)
+            elif kind == "IDENTIFIER":
+                if not text.isascii() and not (text[0].isalpha() or text[0] == "_"):
+                    # \w also accepts numeric characters such as '½' that
+                    # Lexer rejects as the start of an identifier
+                    self.had_error = True
+                    print(f"Unexpected character at line {line}: {text[0]}")
+                    pos = m.start() + 1
+                    continue
+                yield Token(keywords.get(text, TokenType.IDENTIFIER), text, text, line)
+            elif kind == "SPN":
+                yield Token(TokenType.SPN_NOTE, text, text, line)
+            elif kind == "INT":
+                yield Token(TokenType.INT_LITERAL, text, int(text), line)
+            elif kind == "FLOAT":
+                yield Token(TokenType.FLOAT_LITERAL, text, float(text), line)
+            elif kind == "STRING":
+                line += text.count("\n")
+                yield Token(TokenType.STRING_LITERAL, text, text[1:-1], line)
+            elif kind == "UNTERMINATED":
+                line += text.count("\n")
+                self.had_error = True
+                print(f"Unterminated string at line {line}")
+            else:
+                self.had_error = True
+                print(f"Unexpected character at line {line}: {text}")
+
+        self.line = line
+        self.current = end
+        yield Token(TokenType.EOF, "", None, line)
+
+
 ##############################
 # AST NODES
 ##############################
 
+# Nodes list their fields in __slots__ by hand: dataclass(slots=True) needs Python 3.10
 @dataclass
 class Expression:
-    pass
+    __slots__ = ()
 
 @dataclass
 class Command:
-    pass
+    __slots__ = ()
 
 # Expression types
 @dataclass
 class Literal(Expression):
+    __slots__ = ("value",)
     value: Any
 
 @dataclass
 class Variable(Expression):
+    __slots__ = ("name",)
     name: str
 
 @dataclass
 class BinaryExpr(Expression):
+    __slots__ = ("left", "operator", "right")
     left: Expression
     operator: str
     right: Expression
 
 @dataclass
 class Grouping(Expression):
+    __slots__ = ("expression",)
     expression: Expression
 
 # Command types
 @dataclass
 class Assignment(Command):
+    __slots__ = ("name", "operator", "value")
     name: str
     operator: str
     value: Any
 
 @dataclass
 class TimeSignature(Command):
+    __slots__ = ("numerator", "denominator")
     numerator: int
     denominator: int
 
 @dataclass
 class Tempo(Command):
+    __slots__ = ("value",)
     value: int
 
 @dataclass
 class Volume(Command):
+    __slots__ = ("value",)
     value: str
 
 @dataclass
 class Note(Command):
-    pass
+    __slots__ = ()
 
 @dataclass
 class PianoNote(Note):
+    __slots__ = ("hand", "note", "duration")
     hand: str
     note: Any
     duration: Any
 
 @dataclass
 class GuitarNote(Note):
+    __slots__ = ("string", "fret", "duration")
     string: int
     fret: Any
     duration: Any
 
 @dataclass
 class BassNote(Note):
+    __slots__ = ("string", "fret", "duration")
     string: int
     fret: Any
     duration: Any
 
 @dataclass
 class DrumNote(Note):
+    __slots__ = ("drum_type", "duration")
     drum_type: str
     duration: Any
 
+# Produced by AstOptimizer for notes whose MIDI pitch is known up front
+@dataclass
+class ResolvedNote(Note):
+    __slots__ = ("instrument", "note_value", "duration")
+    instrument: str
+    note_value: int
+    duration: Any
+
 @dataclass
 class Pause(Command):
+    __slots__ = ("duration",)
     duration: Any
 
 @dataclass
 class SyncBlock(Command):
+    __slots__ = ("commands",)
     commands: List[Command]
 
 @dataclass
 class ForLoop(Command):
+    __slots__ = ("var_name", "init_value", "condition", "incr_var", "incr_op", "incr_value", "body")
     var_name: str
     init_value: Any
     condition: Expression
@@ -404,6 +565,7 @@ class ForLoop(Command):
 
 @dataclass
 class Track:
+    __slots__ = ("track_type", "commands")
     track_type: str
     commands: List[Command]
 
@@ -416,29 +578,67 @@ class ParseError(Exception):
     pass
 
 class Parser:
-    def __init__(self, tokens: List[Token]):
-        self.tokens = tokens
+    # Tokens pulled per refill when parsing from a token iterator
+    LOOKAHEAD_CHUNK = 64
+
+    def __init__(self, tokens: Union[List[Token], Iterable[Token]]):
         self.current = 0
+        # Set by every error the parser reports, including the ones it
+        # recovers from by dropping or replacing a command
         self.had_error = False
+        
+        if isinstance(tokens, list):
+            self.tokens = tokens
+            self.stream: Optional[Iterator[Token]] = None
+        else:
+            # Lazy mode (e.g. RegexLexer.iter_tokens()): self.tokens only
+            # holds a small window of tokens around self.current
+            self.tokens = []
+            self.stream = iter(tokens)
+            self.fill_lookahead()
     
-    def parse(self) -> List[Track]:
-        tracks = []
+    def fill_lookahead(self) -> None:
+        """Drop consumed tokens and pull the next chunk from the stream.
+
+        previous() and check_next() need tokens[current - 1] and
+        tokens[current + 1], so the window always keeps one token behind
+        the cursor and at least one ahead of it (until the stream runs out).
+        """
+        keep_from = max(self.current - 1, 0)
+        if keep_from:
+            del self.tokens[:keep_from]
+            self.current -= keep_from
         
+        while self.stream is not None and self.current + 1 >= len(self.tokens):
+            chunk = list(islice(self.stream, self.LOOKAHEAD_CHUNK))
+            if not chunk:
+                self.stream = None  # Exhausted, the window now ends with EOF
+                break
+            self.tokens.extend(chunk)
+    
+    def parse(self) -> List[Track]:
+        return list(self.iter_tracks())
+    
+    def iter_tracks(self) -> Iterator[Track]:
+        """Yield each track as soon as it has been parsed"""
         while not self.is_at_end():
             try:
                 if self.check(TokenType.PIANO_TRACK) or self.check(TokenType.GUITAR_TRACK) or \
                    self.check(TokenType.BASS_TRACK) or self.check(TokenType.DRUM_TRACK):
-                    tracks.append(self.track())
+                    track = self.track()
                 else:
                     # Skip tokens until we find a track definition
+                    self.had_error = True
                     print(f"Unexpected token at line {self.peek().line}: {self.peek().lexeme}")
                     self.advance()
+                    continue
             except ParseError as e:
                 self.had_error = True
                 print(f"Parse error: {e}")
                 self.synchronize()
-        
-        return tracks
+                continue
+            
+            yield track
     
     def track(self) -> Track:
         track_type = None
@@ -463,6 +663,7 @@ class Parser:
                 if cmd is not None:  # Skip invalid commands
                     commands.append(cmd)
             except ParseError as e:
+                self.had_error = True
                 print(f"Error in command: {e}")
                 self.synchronize_command()
         
@@ -498,6 +699,7 @@ class Parser:
                 raise ParseError(f"Expected command at line {self.peek().line}")
         except ParseError as e:
             # If we hit a semicolon, we can recover
+            self.had_error = True
             if self.match(TokenType.SEMICOLON):
                 return None
             raise e
@@ -583,6 +785,7 @@ class Parser:
             
         except ParseError as e:
             # Try to recover by skipping to the next semicolon
+            self.had_error = True
             while not self.check(TokenType.SEMICOLON) and not self.is_at_end():
                 self.advance()
             
@@ -640,6 +843,7 @@ class Parser:
                 if cmd is not None:  # Skip invalid commands
                     commands.append(cmd)
             except ParseError as e:
+                self.had_error = True
                 print(f"Error in sync block: {e}")
                 self.synchronize_command()
         
@@ -731,6 +935,7 @@ class Parser:
                 if cmd is not None:  # Skip invalid commands
                     body.append(cmd)
             except ParseError as e:
+                self.had_error = True
                 print(f"Error in for loop body: {e}")
                 self.synchronize_command()
         
@@ -812,13 +1017,16 @@ class Parser:
         return self.peek().type == token_type
     
     def check_next(self, token_type: TokenType) -> bool:
-        if self.current + 1 >= len(self.tokens):
+        # EOF is always the last token, so anything before it has a successor
+        if self.peek().type == TokenType.EOF:
             return False
         return self.tokens[self.current + 1].type == token_type
     
     def advance(self) -> Token:
         if not self.is_at_end():
             self.current += 1
+            if self.stream is not None and self.current + 1 >= len(self.tokens):
+                self.fill_lookahead()
         return self.previous()
     
     def is_at_end(self) -> bool:
@@ -869,82 +1077,2187 @@ class Parser:
             self.advance()
 
 
-##############################
-# INTERPRETER
-##############################
+class IncrementalParser:
+    """Re-parse only the tracks whose source text changed since the last call.
+
+    The source is split at top-level PianoTrack/GuitarTrack/BassTrack/DrumTrack
+    keywords, each chunk is hashed, and the tracks parsed from it are cached
+    under that hash. Editing one track of a four-track song then re-lexes and
+    re-parses just that track; the other three Track ASTs are reused as is.
+    Parse errors stay confined to the chunk (track) they occur in. One
+    instance is shared by concurrent requests, so parse() returns whether
+    the source had errors instead of keeping it on the instance.
+    """
+
+    # Track keywords, skipping over comments and string literals
+    TRACK_BOUNDARY = re.compile(
+        r'//[^\n]*|"[^"]*"?|\b(?P<track>PianoTrack|GuitarTrack|BassTrack|DrumTrack)\b'
+    )
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[str, Tuple[List[Track], bool]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def split_tracks(self, source: str) -> List[Tuple[int, str]]:
+        """Split the source into (start line, text) chunks, one per track"""
+        starts = [m.start() for m in self.TRACK_BOUNDARY.finditer(source) if m.group("track")]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)  # Whatever precedes the first track
+
+        chunks = []
+        line = 1
+        for start, end in zip(starts, starts[1:] + [len(source)]):
+            text = source[start:end]
+            chunks.append((line, text))
+            line += text.count("\n")
+        return chunks
+
+    def parse(self, source: str) -> Tuple[List[Track], bool]:
+        """The tracks of `source`, and whether lexing or parsing it reported errors"""
+        tracks: List[Track] = []
+        had_error = False
+
+        for line, text in self.split_tracks(source):
+            key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+            with self.lock:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+
+            if entry is None:
+                lexer = RegexLexer(text)
+                lexer.line = line
+                parser = Parser(lexer.iter_tokens())
+                entry = (parser.parse(), lexer.had_error or parser.had_error)
+
+                with self.lock:
+                    self.misses += 1
+                    self.cache[key] = entry
+                    while len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+
+            chunk_tracks, chunk_error = entry
+            tracks.extend(chunk_tracks)
+            had_error = had_error or chunk_error
+
+        return tracks, had_error
+
+
+##############################
+# AST CACHE (.mdslc)
+##############################
+
+# Bump whenever the grammar or the AST node classes change, so that stale
+# .mdslc files are ignored instead of decoded into the wrong nodes
+DSL_VERSION = "1"
+
+MDSLC_MAGIC = b"MDSLC"
+MDSLC_FORMAT = 1
+
+# Node classes by their index in the cache file; append only
+AST_NODE_TYPES: List[type] = [
+    Literal, Variable, BinaryExpr, Grouping,
+    Assignment, TimeSignature, Tempo, Volume,
+    PianoNote, GuitarNote, BassNote, DrumNote,
+    Pause, SyncBlock, ForLoop, Track,
+    ResolvedNote,
+]
+AST_NODE_INDEX: Dict[type, int] = {cls: i for i, cls in enumerate(AST_NODE_TYPES)}
+
+def source_digest(source: str) -> bytes:
+    """Cache key of a program: its text plus the DSL version it was parsed with"""
+    return hashlib.sha256(f"{DSL_VERSION}\0{source}".encode("utf-8")).digest()
+
+def encode_ast(value: Any) -> Any:
+    """Flatten AST nodes into nested tuples of plain values for marshal"""
+    if isinstance(value, list):
+        return [encode_ast(item) for item in value]
+    if type(value) in AST_NODE_INDEX:
+        return (AST_NODE_INDEX[type(value)],) + tuple(
+            encode_ast(getattr(value, f.name)) for f in fields(value)
+        )
+    return value
+
+def decode_ast(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decode_ast(item) for item in value]
+    if isinstance(value, tuple):
+        return AST_NODE_TYPES[value[0]](*[decode_ast(item) for item in value[1:]])
+    return value
+
+def save_ast_cache(path: str, source: str, tracks: List[Track]) -> None:
+    """Write the parsed tracks of `source` to a .mdslc file"""
+    payload = zlib.compress(marshal.dumps(encode_ast(tracks), 4))
+    with open(path, "wb") as f:
+        f.write(MDSLC_MAGIC + bytes([MDSLC_FORMAT]) + source_digest(source) + payload)
+
+def load_ast_cache(path: str, source: str) -> Optional[List[Track]]:
+    """Load cached tracks for `source`, or None if missing, stale or unreadable"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    header_size = len(MDSLC_MAGIC) + 1
+    digest = data[header_size:header_size + 32]
+    if data[:header_size] != MDSLC_MAGIC + bytes([MDSLC_FORMAT]) or digest != source_digest(source):
+        return None
+
+    try:
+        return decode_ast(marshal.loads(zlib.decompress(data[header_size + 32:])))
+    except (ValueError, EOFError, TypeError, IndexError, zlib.error) as e:
+        print(f"Ignoring unreadable AST cache {path}: {e}")
+        return None
+
+def ast_cache_path(source_path: str) -> str:
+    return os.path.splitext(source_path)[0] + ".mdslc"
+
+def build_ast_caches(directory: str) -> int:
+    """Precompile every .txt program in `directory` to a .mdslc next to it"""
+    built = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".txt"):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, "r") as f:
+            source = f.read()
+
+        lexer = RegexLexer(source)
+        parser = Parser(lexer.iter_tokens())
+        tracks = parser.parse()
+        if not tracks or lexer.had_error or parser.had_error:
+            # Keep reporting the errors on every run instead of caching them away
+            print(f"Skipping {path}: no valid tracks or parse errors")
+            continue
+
+        save_ast_cache(ast_cache_path(path), source, tracks)
+        print(f"Cached {path} -> {ast_cache_path(path)}")
+        built += 1
+    return built
+
+
+##############################
+# EXECUTION BUDGET
+##############################
+
+class BudgetExceededError(Exception):
+    """Interpretation went over one of the limits of its ExecutionBudget.
+
+    The interpreter prints and skips most run-time errors; this one is
+    always re-raised so that it aborts interpret() for the caller.
+    """
+
+    def __init__(self, limit: str, maximum: float, value: float):
+        super().__init__(f"Execution budget exceeded: {limit} reached {value} (limit {maximum})")
+        self.limit = limit
+        self.maximum = maximum
+        self.value = value
+
+    def __reduce__(self):
+        # Keep the structured fields when crossing a process pool
+        return (BudgetExceededError, (self.limit, self.maximum, self.value))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"error": str(self), "limit": self.limit, "maximum": self.maximum, "value": self.value}
+
+@dataclass
+class ExecutionBudget:
+    """Resource limits for one interpretation; a limit of None is unlimited.
+
+    max_commands counts every command executed, including each run of a
+    loop body or sync block command, max_seconds is the length of the song
+    being produced and max_wall_seconds is a wall-clock deadline.
+    """
+    max_commands: Optional[int] = None
+    max_events: Optional[int] = None
+    max_seconds: Optional[float] = None
+    max_wall_seconds: Optional[float] = None
+
+    def __post_init__(self):
+        self.start()
+
+    def start(self) -> None:
+        self.commands = 0
+        # Events Interpreter.iter_events handed out and no longer stores
+        self.released_events = 0
+        self.started = time.monotonic()
+
+    def charge(self, commands: int, stored_events: int, song_time: float) -> None:
+        """Account for `commands` more commands and check every limit"""
+        self.commands += commands
+        events = stored_events + self.released_events
+        if self.max_commands is not None and self.commands > self.max_commands:
+            raise BudgetExceededError("commands", self.max_commands, self.commands)
+        if self.max_events is not None and events > self.max_events:
+            raise BudgetExceededError("events", self.max_events, events)
+        if self.max_seconds is not None and song_time > self.max_seconds:
+            raise BudgetExceededError("seconds", self.max_seconds, song_time)
+        if self.max_wall_seconds is not None:
+            elapsed = time.monotonic() - self.started
+            if elapsed > self.max_wall_seconds:
+                raise BudgetExceededError("wall_seconds", self.max_wall_seconds, round(elapsed, 3))
+
+def command_cost(command: Command) -> int:
+    """Commands executed by running `command` once, not counting loop iterations"""
+    if isinstance(command, SyncBlock):
+        return 1 + sum(command_cost(sub_command) for sub_command in command.commands)
+    return 1
+
+##############################
+# INTERPRETER
+##############################
+
+# Note to MIDI mapping
+NOTE_TO_MIDI = {
+    'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3,
+    'E': 4, 'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8,
+    'A': 9, 'A#': 10, 'Bb': 10, 'B': 11
+}
+
+# Drum kit mapping (General MIDI)
+DRUM_TO_MIDI = {
+    'KICK': 36,
+    'SNARE': 38,
+    'HIHAT_CLOSED': 42,
+    'HIHAT_OPEN': 46,
+    'HIHAT_PEDAL': 44,
+    'RIDE': 51,
+    'CRASH': 49
+}
+
+class Environment:
+    def __init__(self):
+        self.values: Dict[str, Any] = {}
+    
+    def define(self, name: str, value: Any) -> None:
+        self.values[name] = value
+    
+    def get(self, name: str) -> Any:
+        if name in self.values:
+            return self.values[name]
+        raise RuntimeError(f"Undefined variable '{name}'")
+    
+    def assign(self, name: str, value: Any) -> None:
+        if name in self.values:
+            self.values[name] = value
+            return
+        # Auto-define if not exists
+        self.values[name] = value
+
+# Marks a slot whose variable has not been assigned yet
+UNDEFINED = object()
+
+class SlotEnvironment:
+    """Environment that stores variables in a list, one slot per name.
+
+    TrackCompiler resolves every variable name to a slot index while
+    compiling, so the compiled closures read and write by index and test
+    for UNDEFINED instead of doing a dict membership test and a lookup.
+    """
+
+    def __init__(self):
+        self.slot_index: Dict[str, int] = {}
+        self.slots: List[Any] = []
+
+    def slot(self, name: str) -> int:
+        """Slot index for `name`, allocating an UNDEFINED slot on first use"""
+        index = self.slot_index.get(name)
+        if index is None:
+            index = self.slot_index[name] = len(self.slots)
+            self.slots.append(UNDEFINED)
+        return index
+
+    @property
+    def values(self) -> Dict[str, Any]:
+        """The defined variables by name, like Environment.values"""
+        slots = self.slots
+        return {name: slots[i] for name, i in self.slot_index.items() if slots[i] is not UNDEFINED}
+
+    def define(self, name: str, value: Any) -> None:
+        self.slots[self.slot(name)] = value
+
+    def get(self, name: str) -> Any:
+        index = self.slot_index.get(name)
+        if index is not None and self.slots[index] is not UNDEFINED:
+            return self.slots[index]
+        raise RuntimeError(f"Undefined variable '{name}'")
+
+    def assign(self, name: str, value: Any) -> None:
+        self.define(name, value)
+
+class MusicEvent:
+    __slots__ = ("start_time", "duration")
+
+    def __init__(self, start_time: float, duration: float):
+        self.start_time = start_time
+        self.duration = duration
+
+class NoteEvent(MusicEvent):
+    __slots__ = ("note_value", "velocity", "channel")
+
+    def __init__(self, start_time: float, duration: float, note_value: int, velocity: int, channel: int):
+        super().__init__(start_time, duration)
+        self.note_value = note_value
+        self.velocity = velocity
+        self.channel = channel
+
+class TimeSignatureEvent:
+    __slots__ = ("time", "numerator", "denominator")
+
+    def __init__(self, time: float, numerator: int, denominator: int):
+        self.time = time
+        self.numerator = numerator
+        self.denominator = denominator
+
+class TempoEvent:
+    __slots__ = ("time", "tempo")
+
+    def __init__(self, time: float, tempo: int):
+        self.time = time
+        self.tempo = tempo
+
+
+class PauseEvent(MusicEvent):
+    __slots__ = ()
+
+    def __init__(self, start_time: float, duration: float):
+        super().__init__(start_time, duration)
+
+
+# Event times that are multiples of the quantum and stay below the limit are
+# summed exactly by float64, so shifted copies equal re-executed loop bodies
+EXACT_TIME_QUANTUM = 2.0 ** -20
+EXACT_TIME_LIMIT = 2.0 ** 32
+
+class EventStore:
+    """Columnar store of the note and pause events produced by Interpreter.
+
+    Events live in growable NumPy columns (start, duration, pitch, velocity,
+    channel, kind) so consumers can work on whole arrays instead of walking
+    a list of event objects. Appends are buffered as plain tuples and moved
+    into the columns in chunks, which keeps add_note() cheap in the hot loop.
+
+    Iterating the store still yields NoteEvent/PauseEvent objects, and
+    append() still accepts them, for code written against the old list.
+    """
+
+    NOTE = 0
+    PAUSE = 1
+
+    # Pending rows are moved into the NumPy columns in chunks of this size
+    FLUSH_SIZE = 4096
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.capacity = capacity
+        self.start_column = np.empty(capacity, dtype=np.float64)
+        self.duration_column = np.empty(capacity, dtype=np.float64)
+        self.pitch_column = np.empty(capacity, dtype=np.float64)
+        self.velocity_column = np.empty(capacity, dtype=np.int32)
+        self.channel_column = np.empty(capacity, dtype=np.int32)
+        self.kind_column = np.empty(capacity, dtype=np.int8)
+        self.pending: List[Tuple[float, float, float, int, int, int]] = []
+        # Pitches that are not plain ints (floats, or strings a note variable
+        # held), by event index; the pitch column holds NaN for non-numbers
+        self.raw_pitches: Dict[int, Any] = {}
+
+    def add_note(self, start_time: float, duration: float, note_value: Any, velocity: int, channel: int) -> None:
+        pitch = note_value
+        if type(note_value) is not int:
+            self.raw_pitches[self.size + len(self.pending)] = note_value
+            pitch = note_value if isinstance(note_value, (int, float)) else np.nan
+        self.pending.append((start_time, duration, pitch, velocity, channel, 0))
+        if len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def add_pause(self, start_time: float, duration: float) -> None:
+        self.pending.append((start_time, duration, np.nan, 0, -1, 1))
+        if len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def append(self, event: MusicEvent) -> None:
+        """Compatibility with the old List[MusicEvent] interface"""
+        if isinstance(event, NoteEvent):
+            self.add_note(event.start_time, event.duration, event.note_value, event.velocity, event.channel)
+        else:
+            self.add_pause(event.start_time, event.duration)
+
+    def extend(self, other: "EventStore") -> None:
+        """Append all events of another store, keeping their order"""
+        self.flush()
+        other.flush()
+        offset = self.size
+        self.reserve(self.size + other.size)
+        end = self.size + other.size
+        self.start_column[self.size:end] = other.start_column[:other.size]
+        self.duration_column[self.size:end] = other.duration_column[:other.size]
+        self.pitch_column[self.size:end] = other.pitch_column[:other.size]
+        self.velocity_column[self.size:end] = other.velocity_column[:other.size]
+        self.channel_column[self.size:end] = other.channel_column[:other.size]
+        self.kind_column[self.size:end] = other.kind_column[:other.size]
+        self.size = end
+        for index, value in other.raw_pitches.items():
+            self.raw_pitches[offset + index] = value
+
+    def repeat_block(self, first: int, end: int, copies: int, period: float) -> None:
+        """Append `copies` copies of events [first, end), the k-th shifted by k * period"""
+        self.flush()
+        count = end - first
+        if count <= 0 or copies <= 0:
+            return
+        total = count * copies
+        self.reserve(self.size + total)
+        stop = self.size + total
+        shifts = np.arange(1, copies + 1, dtype=np.float64) * period
+        self.start_column[self.size:stop] = (self.start_column[first:end][None, :] + shifts[:, None]).ravel()
+        for name in ("duration_column", "pitch_column", "velocity_column", "channel_column", "kind_column"):
+            column = getattr(self, name)
+            column[self.size:stop] = np.tile(column[first:end], copies)
+        for index in [i for i in self.raw_pitches if first <= i < end]:
+            value = self.raw_pitches[index]
+            for k in range(1, copies + 1):
+                self.raw_pitches[index + k * count] = value
+        self.size = stop
+
+    def block_is_exact(self, first: int, end: int, origin: float, period: float, repeats: int) -> bool:
+        """True if repeating events [first, end) by shifting is bit-identical to re-running them.
+
+        Float sums only stay exact when every time is a multiple of
+        EXACT_TIME_QUANTUM and nothing grows past EXACT_TIME_LIMIT.
+        """
+        self.flush()
+        starts = self.start_column[first:end]
+        durations = self.duration_column[first:end]
+        times = np.concatenate((starts, durations, [origin, period]))
+        if not np.all(np.isfinite(times)):
+            return False
+        scaled = times / EXACT_TIME_QUANTUM
+        if not np.array_equal(scaled, np.floor(scaled)):
+            return False
+        reach = abs(period) + float(np.max(np.abs(durations), initial=0.0))
+        return abs(origin) + (repeats + 1) * reach < EXACT_TIME_LIMIT
+
+    def reserve(self, size: int) -> None:
+        if size <= self.capacity:
+            return
+        capacity = max(size, self.capacity * 2)
+        for name in ("start_column", "duration_column", "pitch_column",
+                     "velocity_column", "channel_column", "kind_column"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        rows = np.array(self.pending, dtype=np.float64)
+        count = len(rows)
+        self.reserve(self.size + count)
+        end = self.size + count
+        self.start_column[self.size:end] = rows[:, 0]
+        self.duration_column[self.size:end] = rows[:, 1]
+        self.pitch_column[self.size:end] = rows[:, 2]
+        self.velocity_column[self.size:end] = rows[:, 3]
+        self.channel_column[self.size:end] = rows[:, 4]
+        self.kind_column[self.size:end] = rows[:, 5]
+        self.size = end
+        self.pending.clear()
+
+    def __len__(self) -> int:
+        return self.size + len(self.pending)
+
+    # Column views, trimmed to the stored events
+
+    @property
+    def start(self) -> np.ndarray:
+        self.flush()
+        return self.start_column[:self.size]
+
+    @property
+    def duration(self) -> np.ndarray:
+        self.flush()
+        return self.duration_column[:self.size]
+
+    @property
+    def pitch(self) -> np.ndarray:
+        self.flush()
+        return self.pitch_column[:self.size]
+
+    @property
+    def velocity(self) -> np.ndarray:
+        self.flush()
+        return self.velocity_column[:self.size]
+
+    @property
+    def channel(self) -> np.ndarray:
+        self.flush()
+        return self.channel_column[:self.size]
+
+    @property
+    def kind(self) -> np.ndarray:
+        self.flush()
+        return self.kind_column[:self.size]
+
+    # Vectorized queries
+
+    def note_indices(self) -> np.ndarray:
+        return np.flatnonzero(self.kind == self.NOTE)
+
+    def pause_indices(self) -> np.ndarray:
+        return np.flatnonzero(self.kind == self.PAUSE)
+
+    def channel_indices(self, channel: int) -> np.ndarray:
+        """Indices of the notes played on `channel`, in production order"""
+        return np.flatnonzero((self.kind == self.NOTE) & (self.channel == channel))
+
+    def note_channels(self) -> List[int]:
+        """Channels that have notes, in order of their first note"""
+        notes = self.note_indices()
+        channels, first = np.unique(self.channel[notes], return_index=True)
+        return [int(channels[i]) for i in np.argsort(first)]
+
+    def sorted_indices(self, indices: Optional[np.ndarray] = None) -> np.ndarray:
+        """`indices` (default: all events) stably sorted by start time"""
+        if indices is None:
+            indices = np.arange(len(self))
+        return indices[np.argsort(self.start[indices], kind="stable")]
+
+    def end_time(self, indices: Optional[np.ndarray] = None, default: float = 0.0) -> float:
+        """Latest start + duration over `indices` (default: all events)"""
+        if indices is None:
+            indices = np.arange(len(self))
+        if len(indices) == 0:
+            return default
+        return float(np.max(self.start[indices] + self.duration[indices]))
+
+    def pitch_values(self, indices: np.ndarray) -> List[Any]:
+        """Pitches as the interpreter produced them (ints unless raw)"""
+        pitches = self.pitch[indices].tolist()
+        raw = self.raw_pitches
+        if raw:
+            return [raw[i] if i in raw else int(p) for i, p in zip(indices.tolist(), pitches)]
+        return [int(p) for p in pitches]
+
+    def events_at(self, indices: np.ndarray) -> List[MusicEvent]:
+        """NoteEvent/PauseEvent objects for `indices`"""
+        starts = self.start[indices].tolist()
+        durations = self.duration[indices].tolist()
+        kinds = self.kind[indices].tolist()
+        velocities = self.velocity[indices].tolist()
+        channels = self.channel[indices].tolist()
+        raw = self.raw_pitches
+        pitches = self.pitch[indices].tolist()
+
+        events: List[MusicEvent] = []
+        for i, start, duration, kind, pitch, velocity, channel in zip(
+                indices.tolist(), starts, durations, kinds, pitches, velocities, channels):
+            if kind == self.PAUSE:
+                events.append(PauseEvent(start, duration))
+            else:
+                note_value = raw[i] if i in raw else int(pitch)
+                events.append(NoteEvent(start, duration, note_value, velocity, channel))
+        return events
+
+    def pop_until(self, watermark: float) -> List[MusicEvent]:
+        """Remove the events starting at or before `watermark` and return them by start time"""
+        if not self.size and all(row[0] <= watermark for row in self.pending):
+            # Common case: everything buffered since the last call is ready
+            return self.pop_pending()
+        ready = self.start <= watermark
+        events = self.events_at(self.sorted_indices(np.flatnonzero(ready)))
+        keep = np.flatnonzero(~ready)
+        for name in ("start_column", "duration_column", "pitch_column",
+                     "velocity_column", "channel_column", "kind_column"):
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        if self.raw_pitches:
+            self.raw_pitches = {
+                new: self.raw_pitches[old] for new, old in enumerate(keep.tolist()) if old in self.raw_pitches
+            }
+        self.size = len(keep)
+        return events
+
+    def pop_pending(self) -> List[MusicEvent]:
+        """Turn the unflushed rows into events by start time, skipping the columns"""
+        raw = self.raw_pitches
+        events: List[MusicEvent] = []
+        for i, (start, duration, pitch, velocity, channel, kind) in enumerate(self.pending):
+            if kind == self.PAUSE:
+                events.append(PauseEvent(start, duration))
+            else:
+                events.append(NoteEvent(start, duration, raw[i] if i in raw else pitch, velocity, channel))
+        events.sort(key=operator.attrgetter("start_time"))
+        self.pending.clear()
+        raw.clear()
+        return events
+
+    def __iter__(self) -> Iterator[MusicEvent]:
+        """Compatibility iterator over NoteEvent/PauseEvent objects"""
+        return iter(self.events_at(np.arange(len(self))))
+
+
+class TempoMap:
+    """Piecewise-constant tempo over interpreter time, for seconds -> beats.
+
+    Breakpoints are the tempo events sorted by time, each with the beat it
+    falls on; a time converts with one bisect into the breakpoints. When
+    several tracks set the tempo at the same time the last one wins, and
+    the default tempo applies before the first change.
+    """
+
+    def __init__(self, tempo_events: List[TempoEvent], default_tempo: int = 120):
+        breakpoints: Dict[float, int] = {0.0: default_tempo}
+        for event in sorted(tempo_events, key=lambda e: e.time):
+            breakpoints[float(event.time)] = event.tempo
+
+        self.times: List[float] = sorted(breakpoints)
+        self.tempos: List[int] = [breakpoints[time] for time in self.times]
+        self.beat_offsets: List[float] = [0.0]
+        for k in range(1, len(self.times)):
+            span = self.times[k] - self.times[k - 1]
+            self.beat_offsets.append(self.beat_offsets[-1] + span * self.tempos[k - 1] / 60.0)
+
+        self.time_array = np.array(self.times, dtype=np.float64)
+        self.tempo_array = np.array(self.tempos, dtype=np.float64)
+        self.offset_array = np.array(self.beat_offsets, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def segment(self, time: float) -> int:
+        """Index of the breakpoint in effect at `time`"""
+        return max(bisect_right(self.times, time) - 1, 0)
+
+    def tempo_at(self, time: float) -> int:
+        return self.tempos[self.segment(time)]
+
+    def time_to_beats(self, time: float) -> float:
+        k = self.segment(time)
+        return (time - self.times[k]) * self.tempos[k] / 60.0 + self.beat_offsets[k]
+
+    def duration_to_beats(self, duration: float, start_time: float) -> float:
+        k = self.segment(start_time)
+        if self.segment(start_time + duration) == k:
+            return duration * self.tempos[k] / 60.0
+        return self.time_to_beats(start_time + duration) - self.time_to_beats(start_time)
+
+    def segments(self, times: np.ndarray) -> np.ndarray:
+        return np.maximum(np.searchsorted(self.time_array, times, side="right") - 1, 0)
+
+    def times_to_beats(self, times: np.ndarray) -> np.ndarray:
+        """Vectorized time_to_beats over a whole column"""
+        k = self.segments(times)
+        return (times - self.time_array[k]) * self.tempo_array[k] / 60.0 + self.offset_array[k]
+
+    def durations_to_beats(self, durations: np.ndarray, start_times: np.ndarray) -> np.ndarray:
+        """Vectorized duration_to_beats over whole columns"""
+        k = self.segments(start_times)
+        end_times = start_times + durations
+        same_segment = durations * self.tempo_array[k] / 60.0
+        spanning = self.times_to_beats(end_times) - self.times_to_beats(start_times)
+        return np.where(self.segments(end_times) == k, same_segment, spanning)
+
+
+##############################
+# MIDI WRITER
+##############################
+
+class MidiWriter:
+    """Standard MIDI File writer that works on whole note arrays.
+
+    It writes the same events midiutil.MIDIFile would for the same calls
+    (format 1 with a separate tempo track, 960 ticks per quarter note,
+    duplicates removed and overlapping notes of one pitch de-interleaved),
+    but sorts each track once with NumPy, encodes delta times in bulk and
+    uses running status, so files are smaller and much faster to build.
+    """
+
+    TICKS_PER_QUARTER = 960
+
+    NOTE_OFF = 0x80
+    NOTE_ON = 0x90
+    PROGRAM_CHANGE = 0xC0
+
+    # Order of event kinds at the same tick, as in midiutil
+    PROGRAM_ORDER = 1
+    NOTE_OFF_ORDER = 2
+    NOTE_ON_ORDER = 3
+
+    def __init__(self, num_tracks: int):
+        self.num_tracks = num_tracks
+        # Tempo track: (tick, microseconds per quarter, insertion order)
+        self.tempos: List[Tuple[int, int, int]] = []
+        # Channel events per track: (tick, sort order, insertion order, status, data1, data2)
+        self.rows: List[List[np.ndarray]] = [[] for _ in range(num_tracks)]
+        self.counter = 0
+
+    def beats_to_ticks(self, beats: Any) -> Any:
+        if isinstance(beats, np.ndarray):
+            return (beats * self.TICKS_PER_QUARTER).astype(np.int64)
+        return int(beats * self.TICKS_PER_QUARTER)
+
+    def add_program_change(self, track: int, channel: int, beat: float, program: int) -> None:
+        row = (self.beats_to_ticks(beat), self.PROGRAM_ORDER, self.counter,
+               self.PROGRAM_CHANGE | channel, program, -1)
+        self.rows[track].append(np.array([row], dtype=np.int64))
+        self.counter += 1
+
+    def add_tempo(self, beat: float, tempo: float) -> None:
+        self.tempos.append((self.beats_to_ticks(beat), int(60000000 / tempo), self.counter))
+        self.counter += 1
+
+    def add_notes(self, tracks: np.ndarray, channels: np.ndarray, pitches: np.ndarray,
+                  start_beats: np.ndarray, duration_beats: np.ndarray, velocities: np.ndarray) -> None:
+        """Add a note on and note off for every element of the arrays"""
+        count = len(pitches)
+        if count == 0:
+            return
+        start_ticks = self.beats_to_ticks(start_beats)
+        end_ticks = start_ticks + self.beats_to_ticks(duration_beats)
+        order = np.arange(self.counter, self.counter + count, dtype=np.int64)
+        self.counter += count
+
+        for track in np.unique(tracks).tolist():
+            mine = tracks == track
+            n = int(np.count_nonzero(mine))
+            rows = np.empty((2 * n, 6), dtype=np.int64)
+            rows[:n, 0] = start_ticks[mine]
+            rows[:n, 1] = self.NOTE_ON_ORDER
+            rows[:n, 3] = self.NOTE_ON | channels[mine]
+            rows[n:, 0] = end_ticks[mine]
+            rows[n:, 1] = self.NOTE_OFF_ORDER
+            rows[n:, 3] = self.NOTE_OFF | channels[mine]
+            for half in (slice(0, n), slice(n, 2 * n)):
+                rows[half, 2] = order[mine]
+                rows[half, 4] = pitches[mine]
+                rows[half, 5] = velocities[mine]
+            self.rows[track].append(rows)
+
+    def track_events(self, track: int) -> np.ndarray:
+        """The track's rows deduplicated, de-interleaved and sorted for writing"""
+        if not self.rows[track]:
+            return np.empty((0, 6), dtype=np.int64)
+        rows = np.concatenate(self.rows[track])
+
+        # midiutil drops repeated events: notes on or off at the same tick,
+        # pitch and channel, keeping the one added first. Program changes
+        # also compare the program, kept in data1
+        rows = rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 3], rows[:, 4], rows[:, 0]))]
+        kept = np.ones(len(rows), dtype=bool)
+        kept[1:] = np.any(rows[1:, [0, 1, 3, 4]] != rows[:-1, [0, 1, 3, 4]], axis=1)
+        rows = rows[kept]
+
+        rows = self.sort_rows(rows)
+        rows = self.deinterleave(rows)
+        return self.sort_rows(rows)
+
+    @staticmethod
+    def sort_rows(rows: np.ndarray) -> np.ndarray:
+        return rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 0]))]
+
+    def deinterleave(self, rows: np.ndarray) -> np.ndarray:
+        """Move the note off of an overlapped note of the same pitch to the later note's start.
+
+        Mirrors midiutil's stack per pitch and channel: a note off that finds
+        more than one sounding note of its key takes the tick of the most
+        recent note on. Only keys that overlap need the per-event walk.
+        """
+        is_note = rows[:, 1] != self.PROGRAM_ORDER
+        if not np.any(is_note):
+            return rows
+        keys = np.where(is_note, rows[:, 4] * 16 + (rows[:, 3] & 0x0F), -1)
+        is_on = rows[:, 1] == self.NOTE_ON_ORDER
+
+        grouped = np.lexsort((np.arange(len(rows)), keys))
+        steps = np.where(is_on, 1, -1)[grouped]
+        sorted_keys = keys[grouped]
+        totals = np.cumsum(steps)
+        group_first = np.ones(len(rows), dtype=bool)
+        group_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        group_base = np.maximum.accumulate(np.where(group_first, np.arange(len(rows)), 0))
+        depth_before = totals - steps - (totals[group_base] - steps[group_base])
+        overlapped = (sorted_keys >= 0) & ~is_on[grouped] & (depth_before > 1)
+        if not np.any(overlapped):
+            return rows
+
+        rows = rows.copy()
+        stacks: Dict[int, List[int]] = {int(key): [] for key in np.unique(sorted_keys[overlapped])}
+        for index in np.flatnonzero(np.isin(keys, list(stacks))).tolist():
+            stack = stacks[int(keys[index])]
+            if is_on[index]:
+                stack.append(int(rows[index, 0]))
+            elif len(stack) > 1:
+                rows[index, 0] = stack.pop()
+            elif stack:
+                stack.pop()
+        return rows
+
+    @staticmethod
+    def encode_vlq(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Variable-length quantities for `values`: (bytes, byte count per value)"""
+        if np.any(values < 0) or np.any(values > 0x0FFFFFFF):
+            raise ValueError("MIDI delta time out of range")
+        lengths = 1 + (values >= 1 << 7).astype(np.int64) + (values >= 1 << 14) + (values >= 1 << 21)
+        ends = np.cumsum(lengths)
+        out = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+        for k in range(4):
+            has = lengths > k
+            byte = (values[has] >> (7 * k)) & 0x7F
+            out[ends[has] - 1 - k] = byte | (0x80 if k else 0)
+        return out, lengths
+
+    def encode_track(self, rows: np.ndarray) -> bytes:
+        """Channel events with running status, then end of track"""
+        if len(rows) == 0:
+            return b"\x00\xff\x2f\x00"
+        ticks = rows[:, 0]
+        statuses = rows[:, 3]
+        deltas = np.diff(ticks, prepend=0)
+        vlq, vlq_lengths = self.encode_vlq(deltas)
+
+        new_status = np.ones(len(rows), dtype=bool)
+        new_status[1:] = statuses[1:] != statuses[:-1]
+        two_data = rows[:, 5] >= 0
+        lengths = vlq_lengths + new_status + 1 + two_data
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+
+        out = np.zeros(int(ends[-1]), dtype=np.uint8)
+        # Scatter each VLQ into place: its bytes are consecutive
+        vlq_targets = np.repeat(starts, vlq_lengths) + (
+            np.arange(len(vlq)) - np.repeat(np.cumsum(vlq_lengths) - vlq_lengths, vlq_lengths))
+        out[vlq_targets] = vlq
+        position = starts + vlq_lengths
+        out[position[new_status]] = statuses[new_status]
+        position = position + new_status
+        out[position] = rows[:, 4]
+        out[position[two_data] + 1] = rows[two_data, 5]
+        return out.tobytes() + b"\x00\xff\x2f\x00"
+
+    def encode_tempo_track(self) -> bytes:
+        # midiutil drops repeated tempo events at the same tick
+        unique: Dict[Tuple[int, int], int] = {}
+        for tick, tempo, order in self.tempos:
+            unique.setdefault((tick, tempo), order)
+        data = bytearray()
+        previous = 0
+        for (tick, tempo), order in sorted(unique.items(), key=lambda item: (item[0][0], item[1])):
+            vlq, _ = self.encode_vlq(np.array([tick - previous], dtype=np.int64))
+            data += vlq.tobytes()
+            data += b"\xff\x51\x03" + tempo.to_bytes(4, "big")[1:]
+            previous = tick
+        return bytes(data) + b"\x00\xff\x2f\x00"
+
+    def to_bytes(self) -> bytes:
+        chunks = [self.encode_tempo_track()]
+        chunks += [self.encode_track(self.track_events(track)) for track in range(self.num_tracks)]
+        header = b"MThd" + (6).to_bytes(4, "big") + (1).to_bytes(2, "big") \
+            + len(chunks).to_bytes(2, "big") + self.TICKS_PER_QUARTER.to_bytes(2, "big")
+        return header + b"".join(b"MTrk" + len(chunk).to_bytes(4, "big") + chunk for chunk in chunks)
+
+    def write(self, file: Any) -> None:
+        file.write(self.to_bytes())
+
+
+##############################
+# NOTE RENDERING
+##############################
+
+SAMPLE_RATE = 44100
+
+# "additive" sums np.sin harmonics per sample; "wavetable" looks the same
+# single-cycle waveform up in a precomputed table; "fundamental" plays a
+# plain sine at the note's pitch
+SYNTHESIS_MODES = ("additive", "wavetable", "fundamental")
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """Audio quality settings for synthesize_basic_wav and convert_midi_to_mp3"""
+    name: str
+    sample_rate: int
+    synthesis: Optional[str]  # None keeps the interpreter's synthesis mode
+    bitrate_kbps: int
+
+RENDER_PROFILES: Dict[str, RenderProfile] = {
+    # Full quality, for export
+    "final": RenderProfile("final", SAMPLE_RATE, None, 192),
+    # Half the samples, one sine per note and a small MP3, for quick IDE runs
+    "preview": RenderProfile("preview", 22050, "fundamental", 64),
+}
+
+# Samples per block of the streaming renderer (about 1.5 s)
+AUDIO_BLOCK_SAMPLES = 65536
+
+# Shortest time shard worth handing to a render worker
+MIN_SHARD_SECONDS = 10
+
+# "peak" scales by the whole song's peak (two passes); "limiter" levels it
+# in one pass with a LookaheadLimiter, so blocks can be emitted as they are mixed
+NORMALIZE_MODES = ("peak", "limiter")
+
+# Loudness applied to MP3 output: pydub's normalize() headroom, then extra gain
+MASTERING_HEADROOM_DB = 0.1
+MASTERING_GAIN_DB = 6.0
+
+# Samples per single-cycle wavetable (a power of two, so phase wraps with a mask)
+WAVETABLE_SIZE = 4096
+
+def additive_signal(channel: int, frequency: float, t: np.ndarray) -> np.ndarray:
+    """Pitched instrument waveform evaluated with np.sin at times t"""
+    if channel == 0:  # Piano
+        # Rich harmonics for piano
+        signal = np.sin(2.0 * np.pi * frequency * t)
+        signal += 0.5 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
+        signal += 0.3 * np.sin(2.0 * np.pi * 3 * frequency * t)  # 2nd harmonic
+    elif channel == 1:  # Guitar
+        # Guitar-like sound with rich harmonics
+        signal = np.sin(2.0 * np.pi * frequency * t)
+        signal += 0.5 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
+        signal += 0.2 * np.sin(2.0 * np.pi * 3 * frequency * t)  # 2nd harmonic
+        
+        # Add slight distortion for character
+        signal = np.tanh(1.5 * signal)
+    elif channel == 2:  # Bass
+        # Bass sound with more fundamental and less harmonics
+        signal = np.sin(2.0 * np.pi * frequency * t)
+        signal += 0.3 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
+        
+        # Add some warmth with soft clipping
+        signal = np.tanh(1.2 * signal)
+    else:
+        # Default instrument sound
+        signal = np.sin(2.0 * np.pi * frequency * t)
+    return signal
+
+WAVETABLES: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+def wavetable(channel: int) -> Tuple[np.ndarray, np.ndarray]:
+    """One cycle of the channel's timbre and the slope from each entry to the next"""
+    tables = WAVETABLES.get(channel)
+    if tables is None:
+        phase = np.arange(WAVETABLE_SIZE + 1) / WAVETABLE_SIZE
+        cycle = additive_signal(channel, 1.0, phase)
+        cycle[-1] = cycle[0]  # Wrap-around point for interpolation
+        tables = (cycle[:-1].copy(), np.diff(cycle))
+        for table in tables:
+            table.flags.writeable = False
+        WAVETABLES[channel] = tables
+    return tables
+
+def wavetable_signal(channel: int, frequency: float, note_duration: float,
+                     sample_count: int) -> np.ndarray:
+    """Pitched instrument waveform read from its wavetable by a phase accumulator"""
+    table, slope = wavetable(channel)
+    # Table positions advanced per sample, matching the additive time step
+    increment = frequency * note_duration / sample_count * WAVETABLE_SIZE
+    phase = np.arange(sample_count) * increment
+    
+    # Linear interpolation between neighbouring table entries
+    index = phase.astype(np.int64)
+    phase -= index
+    index &= WAVETABLE_SIZE - 1
+    phase *= slope.take(index)
+    phase += table.take(index)
+    return phase
+
+def note_envelope(channel: int, note_duration: float, sample_count: int) -> np.ndarray:
+    """Amplitude envelope of a pitched instrument note"""
+    if channel == 0:  # Piano
+        # Piano-like envelope with sharp attack and gradual decay
+        attack = int(0.01 * sample_count)
+        decay = sample_count - attack
+        envelope = np.ones(sample_count)
+        if attack > 0:
+            envelope[:attack] = np.linspace(0, 1, attack)
+        if decay > 0:
+            envelope[attack:] = np.exp(-3 * np.linspace(0, 1, decay))
+    elif channel == 1:  # Guitar
+        # Guitar-like envelope with quick attack and longer sustain
+        attack = int(0.005 * sample_count)
+        decay = int(0.1 * sample_count)
+        sustain = sample_count - attack - decay
+        
+        envelope = np.ones(sample_count)
+        if attack > 0:
+            envelope[:attack] = np.linspace(0, 1, attack)
+        if decay > 0 and sustain > 0:
+            envelope[attack:attack+decay] = np.linspace(1, 0.7, decay)
+            envelope[attack+decay:] = np.linspace(0.7, 0.5, sustain)
+    elif channel == 2:  # Bass
+        # Bass-like envelope with medium attack and long sustain
+        attack = int(0.01 * sample_count)
+        decay = int(0.1 * sample_count)
+        sustain = sample_count - attack - decay
+        
+        envelope = np.ones(sample_count)
+        if attack > 0:
+            envelope[:attack] = np.linspace(0, 1, attack)
+        if decay > 0 and sustain > 0:
+            envelope[attack:attack+decay] = np.linspace(1, 0.8, decay)
+            envelope[attack+decay:] = np.linspace(0.8, 0.6, sustain)
+    else:
+        t = np.linspace(0, note_duration, sample_count, endpoint=False)
+        envelope = np.exp(-3 * t/note_duration)
+    return envelope
+
+# Seeded white noise shared by all drum hits, so renders are reproducible
+DRUM_NOISE_SEED = 0x5EED
+DRUM_NOISE_SAMPLES = 1 << 18  # About 6 s
+
+DRUM_NOISE: Optional[np.ndarray] = None
+
+def drum_noise(note_value: int, sample_count: int) -> np.ndarray:
+    """Uniform noise in [-1, 1) for one drum hit, read from the seeded noise table.
+
+    Each drum sound starts at its own offset in the table, so different
+    drums do not share a noise pattern; hits longer than the table wrap.
+    """
+    global DRUM_NOISE
+    if DRUM_NOISE is None:
+        table = np.random.default_rng(DRUM_NOISE_SEED).uniform(-1.0, 1.0, DRUM_NOISE_SAMPLES)
+        table.flags.writeable = False
+        DRUM_NOISE = table
+    offset = note_value * 7919 % DRUM_NOISE_SAMPLES
+    return np.take(DRUM_NOISE, np.arange(offset, offset + sample_count), mode="wrap")
+
+def render_note(channel: int, note_value: int, note_duration: float, velocity: int,
+                sample_count: int, synthesis: str = "additive") -> np.ndarray:
+    """Render one note's samples, already enveloped and scaled by velocity"""
+    # Get frequency from MIDI note
+    frequency = 440.0 * (2.0 ** ((note_value - 69) / 12.0))
+    
+    # Different waveform based on instrument type
+    if channel != 9:
+        if synthesis == "wavetable":
+            signal = wavetable_signal(channel, frequency, note_duration, sample_count)
+        elif synthesis == "fundamental":
+            t = np.linspace(0, note_duration, sample_count, endpoint=False)
+            signal = np.sin(2.0 * np.pi * frequency * t)
+        else:
+            # Generate samples - use a mix of sine wave and sawtooth for more presence
+            t = np.linspace(0, note_duration, sample_count, endpoint=False)
+            signal = additive_signal(channel, frequency, t)
+        envelope = note_envelope(channel, note_duration, sample_count)
+    else:  # Drums
+        t = np.linspace(0, note_duration, sample_count, endpoint=False)
+        
+        # Percussion sounds - more noise components
+        if note_value == 36:  # Kick
+            # Low frequency sine with quick decay
+            signal = np.sin(2.0 * np.pi * frequency * t) + 0.5 * np.sin(2.0 * np.pi * (frequency/2) * t)
+            envelope = np.exp(-5 * t/note_duration)
+        elif note_value == 38:  # Snare
+            # Mix of sine and noise
+            noise = 0.5 * drum_noise(note_value, sample_count)
+            signal = 0.5 * np.sin(2.0 * np.pi * frequency * t) + 0.5 * noise
+            envelope = np.exp(-8 * t/note_duration)
+        else:  # Other percussion
+            # Mostly noise with some tone
+            noise = 0.7 * drum_noise(note_value, sample_count)
+            signal = 0.3 * np.sin(2.0 * np.pi * frequency * t) + 0.7 * noise
+            envelope = np.exp(-10 * t/note_duration)
+    
+    # Apply velocity scaling
+    velocity_factor = velocity / 127.0
+    
+    # Apply envelope and velocity
+    samples = signal * envelope * velocity_factor
+    
+    # Scale to avoid clipping
+    samples = samples * 0.5
+    
+    return samples
+
+
+class NoteRenderCache:
+    """Bounded LRU cache of rendered note buffers.
+
+    A song plays the same (channel, pitch, duration, velocity) combinations over
+    and over, so synthesize_basic_wav renders each one once and slice-adds the
+    cached buffer afterwards. The sample count is part of the key because a note
+    cut off at the end of the song is rendered over fewer samples, and the
+    synthesis mode and sample rate are part of it too, so preview and final
+    renders sharing a cache never get each other's buffers. Drum hits read their noise from the
+    seeded drum_noise table, so they are cached like any other note.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache: "OrderedDict[Tuple[int, int, float, int, int, str, int], np.ndarray]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def render(self, channel: int, note_value: int, note_duration: float, velocity: int,
+               sample_count: int, synthesis: str = "additive", sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+        key = (channel, note_value, note_duration, velocity, sample_count, synthesis, sample_rate)
+        with self.lock:
+            samples = self.cache.get(key)
+            if samples is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return samples
+
+        samples = render_note(channel, note_value, note_duration, velocity, sample_count, synthesis)
+        samples.flags.writeable = False
+
+        with self.lock:
+            self.misses += 1
+            if samples.nbytes <= self.max_bytes and key not in self.cache:
+                self.cache[key] = samples
+                self.nbytes += samples.nbytes
+                while len(self.cache) > self.max_entries or self.nbytes > self.max_bytes:
+                    self.nbytes -= self.cache.popitem(last=False)[1].nbytes
+        return samples
+
+    def clear(self) -> None:
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# (production position, start sample, end sample, channel, pitch, duration, velocity)
+Voice = Tuple[int, int, int, int, Any, float, int]
+
+def mix_audio_blocks(voices: List[Voice], first_sample: int, last_sample: int, block_samples: int,
+                     note_cache: NoteRenderCache, synthesis: str, sample_rate: int) -> Iterator[np.ndarray]:
+    """Mix the samples [first_sample, last_sample) as float32 blocks.
+
+    `voices` is sorted by start sample. Each note is rendered when its block
+    begins and kept only while it sounds; notes that began before
+    first_sample are rendered whole and contribute their remaining part.
+    Active notes are added in production order, so every sample comes out
+    as if the whole song had been mixed into one buffer.
+    """
+    active: List[Tuple[int, int, np.ndarray]] = []  # (position, start sample, samples)
+    upcoming = 0
+    for block_start in range(first_sample, last_sample, block_samples):
+        block_end = min(block_start + block_samples, last_sample)
+        while upcoming < len(voices) and voices[upcoming][1] < block_end:
+            position, start, end, channel, pitch, duration, velocity = voices[upcoming]
+            samples = note_cache.render(channel, pitch, duration, velocity, end - start, synthesis, sample_rate)
+            active.append((position, start, samples))
+            upcoming += 1
+        active.sort(key=operator.itemgetter(0))
+        
+        block = np.zeros(block_end - block_start, dtype=np.float32)
+        for _, start, samples in active:
+            low = max(start, block_start)
+            high = min(start + len(samples), block_end)
+            if high > low:
+                block[low - block_start:high - block_start] += samples[low - start:high - start]
+        active = [voice for voice in active if voice[1] + len(voice[2]) > block_end]
+        yield block
+
+def spill_audio_blocks(blocks: Iterable[np.ndarray], spill: BinaryIO) -> np.float32:
+    """Write float32 blocks to `spill` and return their peak absolute value"""
+    peak = np.float32(0)
+    for block in blocks:
+        if len(block):
+            peak = max(peak, np.max(np.abs(block)))
+        spill.write(block.tobytes())
+    return peak
+
+def normalized_pcm_peak() -> int:
+    """The int16 peak pcm_blocks produces for any song that is not silent"""
+    block = np.ones(1, dtype=np.float32) / np.float32(1) * 0.9
+    return int((np.tanh(block) * 32767).astype(np.int16)[0])
+
+def mastering_gains() -> Tuple[float, float]:
+    """Gains of pydub's normalize() and of MASTERING_GAIN_DB on normalized PCM"""
+    target_peak = 32768 * 10 ** (-MASTERING_HEADROOM_DB / 20)
+    normalize_db = 20 * math.log(target_peak / normalized_pcm_peak(), 10)
+    return 10 ** (normalize_db / 20), 10 ** (MASTERING_GAIN_DB / 20)
+
+def master_pcm(pcm: np.ndarray) -> np.ndarray:
+    """Apply the normalize and gain stages the way pydub (audioop.mul) does:
+    each scales, clips to int16 and rounds down"""
+    samples = pcm.astype(np.float64)
+    for gain in mastering_gains():
+        samples *= gain
+        np.clip(samples, -32768, 32767, out=samples)
+        np.floor(samples, out=samples)
+    return samples.astype(np.int16)
+
+def spilled_blocks(spill: BinaryIO, sample_count: int, block_samples: int) -> Iterator[np.ndarray]:
+    """Read float32 samples written by spill_audio_blocks back in blocks"""
+    for block_start in range(0, sample_count, block_samples):
+        count = min(block_samples, sample_count - block_start)
+        yield np.frombuffer(spill.read(count * 4), dtype=np.float32)
+
+def to_pcm(block: np.ndarray, master: bool) -> np.ndarray:
+    """Soft-limit a normalized float block and convert it to int16, mastered if asked"""
+    max_amplitude = 32767  # 16-bit
+    
+    # Apply a gentle limiter to prevent clipping
+    block = np.tanh(block)
+    
+    # Convert to 16-bit PCM
+    pcm = (block * max_amplitude).astype(np.int16)
+    return master_pcm(pcm) if master else pcm
+
+def pcm_blocks(blocks: Iterable[np.ndarray], peak: np.float32, master: bool = False) -> Iterator[np.ndarray]:
+    """Normalize float32 blocks by the song's peak and convert them to int16"""
+    for block in blocks:
+        # Normalize to prevent clipping
+        if peak > 0:
+            block = block / peak * 0.9  # Leave some headroom
+        yield to_pcm(block, master)
+
+class LookaheadLimiter:
+    """Single-pass stand-in for normalizing by the song's peak.
+
+    Samples are grouped in frames of FRAME samples. The gain at each frame
+    boundary is the smallest gain that keeps every frame from the previous
+    one through LOOKAHEAD_FRAMES ahead at or below CEILING (the level the
+    peak normalizer maps the song's peak to), capped at MAX_GAIN. After a
+    peak the gain recovers by at most a factor of two per RELEASE_SECONDS,
+    and it is interpolated linearly inside each frame. Both ends of every
+    ramp respect the frame's own peak, so no sample goes over CEILING.
+
+    process() takes any block size and returns what the delay line lets
+    out, (LOOKAHEAD_FRAMES + 2) * FRAME samples behind; flush() returns the
+    rest. The output has exactly as many samples as the input.
+    """
+
+    FRAME = 512
+    LOOKAHEAD_FRAMES = 4
+    CEILING = 0.9
+    MAX_GAIN = 18.0  # +25 dB for very quiet songs
+    RELEASE_SECONDS = 10.0  # Slow, so levels track the peak normalizer within 1-2 dB
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE):
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.required: List[float] = []  # Gain each pending whole frame allows
+        self.previous_required = self.MAX_GAIN  # For the last frame already output
+        self.gain: Optional[float] = None  # At the start of the first pending frame
+        self.growth = 2.0 ** (self.FRAME / sample_rate / self.RELEASE_SECONDS)
+        self.samples_in = 0
+        self.samples_out = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        self.samples_in += len(block)
+        self.pending = np.concatenate((self.pending, block.astype(np.float32, copy=False)))
+        
+        frame = self.FRAME
+        whole_frames = len(self.pending) // frame
+        if whole_frames > len(self.required):
+            peaks = np.abs(self.pending[len(self.required) * frame:whole_frames * frame]).reshape(-1, frame).max(axis=1)
+            self.required.extend(np.minimum(self.MAX_GAIN, self.CEILING / np.maximum(peaks, 1e-12)).tolist())
+        
+        # Frame j can go out once the frames up to j + 1 + LOOKAHEAD_FRAMES are known
+        ready = len(self.required) - self.LOOKAHEAD_FRAMES - 1
+        if ready <= 0:
+            return np.zeros(0, dtype=np.float32)
+        
+        window = self.LOOKAHEAD_FRAMES + 2
+        required = [self.previous_required] + self.required
+        gains = [self.gain if self.gain is not None else min(required[:window])]
+        for j in range(ready):
+            gains.append(min(min(required[j + 1:j + 1 + window]), gains[-1] * self.growth))
+        
+        gains = np.array(gains)
+        ramp = np.arange(frame) / frame
+        envelope = (gains[:-1, None] + (gains[1:] - gains[:-1])[:, None] * ramp).ravel()
+        output = self.pending[:ready * frame] * envelope
+        
+        self.pending = self.pending[ready * frame:]
+        self.previous_required = self.required[ready - 1]
+        self.required = self.required[ready:]
+        self.gain = float(gains[-1])
+        self.samples_out += len(output)
+        return output.astype(np.float32)
+
+    def flush(self) -> np.ndarray:
+        # Silence after the end lets the last frames through
+        padding = (self.LOOKAHEAD_FRAMES + 3) * self.FRAME - len(self.pending) % self.FRAME
+        remaining = self.samples_in - self.samples_out
+        output = self.process(np.zeros(padding, dtype=np.float32))
+        return output[:remaining]
+
+def limited_pcm_blocks(blocks: Iterable[np.ndarray], master: bool = False,
+                       sample_rate: int = SAMPLE_RATE) -> Iterator[np.ndarray]:
+    """Run float32 blocks through a LookaheadLimiter and convert them to int16"""
+    limiter = LookaheadLimiter(sample_rate)
+    for block in blocks:
+        output = limiter.process(block)
+        if len(output):
+            yield to_pcm(output, master)
+    yield to_pcm(limiter.flush(), master)
+
+
+def write_wav(target: Union[str, BinaryIO], sample_count: int, blocks: Iterable[Any],
+              sample_rate: int = SAMPLE_RATE) -> None:
+    """Write mono 16-bit WAV frames block by block (arrays or raw bytes)"""
+    with wave.open(target, 'wb') as wav_file_obj:
+        wav_file_obj.setnchannels(1)  # Mono
+        wav_file_obj.setsampwidth(2)  # 16-bit
+        wav_file_obj.setframerate(sample_rate)
+        # Known up front, so the header never needs patching (works on pipes)
+        wav_file_obj.setnframes(sample_count)
+        for block in blocks:
+            wav_file_obj.writeframesraw(block if isinstance(block, bytes) else block.tobytes())
+
+
+##############################
+# STREAMING ENCODER
+##############################
+
+class EncoderError(Exception):
+    """The MP3 encoder subprocess failed or is not installed"""
+
+def encoder_command(bitrate_kbps: int = 192, sample_rate: int = SAMPLE_RATE) -> Optional[List[str]]:
+    """Command that reads raw mono s16le PCM on stdin and writes MP3 to stdout,
+    using whichever of ffmpeg or lame is installed"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        return [ffmpeg, "-hide_banner", "-loglevel", "error",
+                "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+                "-b:a", f"{bitrate_kbps}k", "-f", "mp3", "pipe:1"]
+    lame = shutil.which("lame")
+    if lame:
+        return [lame, "--quiet", "-r", "-s", str(sample_rate / 1000), "--signed", "--little-endian",
+                "--bitwidth", "16", "-m", "m", "-b", str(bitrate_kbps), "-", "-"]
+    return None
+
+class StreamingEncoder:
+    """One encoder process per job, fed PCM blocks as they are rendered.
+
+    write() pipes each block to the encoder's stdin while a reader thread
+    copies encoded frames from its stdout to `output` as they come out (a
+    second one drains stderr), so neither pipe can fill up and stall the
+    other side. close() waits for the encoder and raises EncoderError if
+    it failed. If writing to `output` fails, the reader kills the encoder
+    (which could otherwise block on its full stdout and stop reading) and
+    the next write() or close() raises EncoderError.
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, output: BinaryIO, command: Optional[List[str]] = None):
+        command = command or encoder_command()
+        if command is None:
+            raise EncoderError("No MP3 encoder found (install ffmpeg or lame)")
+        self.output = output
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        self.errors: List[bytes] = []
+        # Exception raised by output.write in the reader thread
+        self.output_error: Optional[Exception] = None
+        self.reader = threading.Thread(target=self.copy_output, daemon=True)
+        self.error_reader = threading.Thread(target=lambda: self.errors.append(self.process.stderr.read()),
+                                             daemon=True)
+        self.reader.start()
+        self.error_reader.start()
+
+    def copy_output(self) -> None:
+        try:
+            for chunk in iter(lambda: self.process.stdout.read1(self.READ_SIZE), b""):
+                self.output.write(chunk)
+        except Exception as e:
+            self.output_error = e
+            self.process.kill()
+
+    def write(self, block: Any) -> None:
+        if self.output_error is not None:
+            self.close()  # Raises EncoderError for the output error
+        try:
+            self.process.stdin.write(block if isinstance(block, bytes) else block.tobytes())
+        except BrokenPipeError:
+            self.close()  # Reports why the encoder stopped reading
+            raise EncoderError("MP3 encoder exited early")
+
+    def close(self) -> None:
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self.process.wait()
+        self.reader.join()
+        self.error_reader.join()
+        if self.output_error is not None:
+            raise EncoderError(f"Could not write the encoded MP3: {self.output_error}") from self.output_error
+        if returncode != 0:
+            message = b"".join(self.errors).decode("utf-8", "replace").strip()
+            raise EncoderError(f"MP3 encoder exited with status {returncode}: {message}")
+
+    def __enter__(self) -> "StreamingEncoder":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
+
+
+##############################
+# OPTIMIZER
+##############################
+
+# Single-digit SPN check used by Assignment/ForLoop/evaluate_value
+SPN_VALUE_PATTERN = re.compile(r'^[A-G][b#]?\d$')
+
+BINARY_OPERATORS: Dict[str, Callable[[Any, Any], Any]] = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+# Guitar strings from low to high: E2, A2, D3, G3, B3, E4 (standard tuning)
+GUITAR_STRINGS = (40, 45, 50, 55, 59, 64)
+# Bass strings from low to high: E1, A1, D2, G2 (standard tuning)
+BASS_STRINGS = (28, 33, 38, 43)
+
+# Full SPN note; never a variable name, since the lexer turns it into SPN_NOTE
+SPN_NOTE_PATTERN = re.compile(r'[A-G][b#]?\d+')
+
+class AstOptimizer:
+    """Rewrite a Track into an equivalent one that is cheaper to interpret.
+
+    Runs before interpretation and returns new nodes, leaving the input AST
+    untouched (parsed tracks are shared through IncrementalParser and the
+    .mdslc cache). Literal SPN notes become MIDI numbers, literal durations
+    become floats, constant guitar/bass/drum notes become ResolvedNotes and
+    constant binary expressions are folded, so neither the tree walker nor
+    the compiled closures have to match regexes or dispatch on types for them.
+    """
+
+    def optimize_track(self, track: Track) -> Track:
+        return Track(track.track_type, self.optimize_block(track.commands))
+
+    def optimize_block(self, commands: List[Command]) -> List[Command]:
+        return [self.optimize_command(command) for command in commands]
+
+    def optimize_command(self, command: Command) -> Command:
+        if isinstance(command, PianoNote):
+            note = command.note
+            if isinstance(note, str) and SPN_NOTE_PATTERN.fullmatch(note):
+                note_name, octave = re.match(r'([A-G][b#]?)(\d+)', note).groups()
+                if note_name in NOTE_TO_MIDI:  # E#4, Cb4, ... fail at run time
+                    note = NOTE_TO_MIDI[note_name] + (int(octave) + 1) * 12
+            return PianoNote(command.hand, note, self.optimize_duration(command.duration))
+
+        elif isinstance(command, (GuitarNote, BassNote)):
+            instrument = "guitar" if isinstance(command, GuitarNote) else "bass"
+            duration = self.optimize_duration(command.duration)
+            if not isinstance(command.fret, str):
+                base_notes = GUITAR_STRINGS if instrument == "guitar" else BASS_STRINGS
+                try:
+                    string_idx = min(command.string - 1, len(base_notes) - 1)
+                    return ResolvedNote(instrument, base_notes[string_idx] + command.fret, duration)
+                except Exception:
+                    pass  # Leave the error to surface at run time
+            return type(command)(command.string, command.fret, duration)
+
+        elif isinstance(command, DrumNote):
+            duration = self.optimize_duration(command.duration)
+            if command.drum_type in DRUM_TO_MIDI:
+                return ResolvedNote("drum", DRUM_TO_MIDI[command.drum_type], duration)
+            return DrumNote(command.drum_type, duration)
+
+        elif isinstance(command, Pause):
+            return Pause(self.optimize_duration(command.duration))
+
+        elif isinstance(command, SyncBlock):
+            return SyncBlock(self.optimize_block(command.commands))
+
+        elif isinstance(command, ForLoop):
+            init_value = command.init_value
+            if isinstance(init_value, str) and SPN_VALUE_PATTERN.match(init_value):
+                init_value = Literal(init_value)  # Notes are stored as strings
+            return ForLoop(
+                command.var_name, init_value, self.optimize_expression(command.condition),
+                command.incr_var, command.incr_op, self.optimize_value(command.incr_value),
+                self.optimize_block(command.body),
+            )
+
+        elif isinstance(command, Assignment):
+            value = command.value
+            if isinstance(value, Expression):
+                value = self.optimize_expression(value)
+            elif command.operator == "=":
+                if isinstance(value, str) and SPN_VALUE_PATTERN.match(value):
+                    value = Literal(value)  # Notes are stored as strings
+            else:
+                value = self.optimize_value(value)
+            return Assignment(command.name, command.operator, value)
+
+        return command
+
+    def optimize_duration(self, duration: Any) -> Any:
+        if isinstance(duration, (int, float)):
+            return float(duration)
+        return duration
+
+    def optimize_value(self, value: Any) -> Any:
+        """Pre-resolve what Interpreter.evaluate_value would compute"""
+        if isinstance(value, Expression):
+            return self.optimize_expression(value)
+        if isinstance(value, str) and SPN_VALUE_PATTERN.match(value):
+            note_name, octave = re.match(r'([A-G][b#]?)(\d+)', value).groups()
+            if note_name in NOTE_TO_MIDI:  # E#4, Cb4, ... fail at run time
+                return Literal(NOTE_TO_MIDI[note_name] + (int(octave) + 1) * 12)
+        return value
+
+    def optimize_expression(self, expr: Expression) -> Expression:
+        if isinstance(expr, Grouping):
+            return self.optimize_expression(expr.expression)
+        elif isinstance(expr, BinaryExpr):
+            left = self.optimize_expression(expr.left)
+            right = self.optimize_expression(expr.right)
+            binary = BINARY_OPERATORS.get(expr.operator)
+            if binary is not None and isinstance(left, Literal) and isinstance(right, Literal):
+                try:
+                    return Literal(binary(left.value, right.value))
+                except Exception:
+                    pass  # e.g. division by zero, raised again at run time
+            return BinaryExpr(left, expr.operator, right)
+        return expr
+
+
+##############################
+# COMPILER
+##############################
+
+class TrackCompiler:
+    """Compile a Track into prebound closures that run against an Interpreter.
+
+    All type dispatch (the isinstance chain in execute_command, the operator
+    string compares in evaluate, literal vs variable checks) happens once at
+    compile time. The closures then only touch interpreter state, and produce
+    exactly the same events, prints and errors as the tree-walking path.
+    """
+
+    def __init__(self, interpreter: "Interpreter"):
+        self.interpreter = interpreter
+
+    def compile_track(self, track: Track) -> List[Callable[[], None]]:
+        if self.interpreter.budget is None:
+            return self.compile_block(track.commands, track.track_type)
+        compiled = []
+        for command in track.commands:
+            run = self.compile_command(command, track.track_type)
+            compiled.append(self.charged(run, command_cost(command)))
+        return compiled
+
+    def charged(self, run: Optional[Callable[[], Any]], cost: int) -> Callable[[], Any]:
+        """Wrap a top-level closure so it charges the budget before running"""
+        charge = self.interpreter.charge
+
+        def run_charged() -> Any:
+            charge(cost)
+            return run() if run is not None else None
+        return run_charged
+
+    def compile_steps(self, track: Track) -> List[Callable[[], Iterator[None]]]:
+        """Compile a track's top-level commands into closures returning iterators.
+
+        Each iterator runs its command and yields whenever no later event of
+        the track can start before the current time: once at the end of the
+        command, and after every iteration of a top-level for loop.
+        """
+        steps: List[Callable[[], Iterator[None]]] = []
+        for command in track.commands:
+            if isinstance(command, ForLoop):
+                step = self.compile_for_loop(command, track.track_type, stepwise=True)
+            else:
+                run = self.compile_command(command, track.track_type)
+                if run is None and self.interpreter.budget is None:
+                    continue
+                step = self.single_step(run)
+            if self.interpreter.budget is not None:
+                step = self.charged(step, command_cost(command))
+            steps.append(step)
+        return steps
+
+    @staticmethod
+    def single_step(run: Optional[Callable[[], None]]) -> Callable[[], Iterator[None]]:
+        def step() -> Iterator[None]:
+            if run is not None:
+                run()
+            yield
+        return step
+
+    def compile_block(self, commands: List[Command], track_type: str) -> List[Callable[[], None]]:
+        compiled = [self.compile_command(command, track_type) for command in commands]
+        # Commands execute_command does not handle are no-ops; drop them
+        return [run for run in compiled if run is not None]
+
+    def compile_command(self, command: Command, track_type: str) -> Optional[Callable[[], None]]:
+        it = self.interpreter
+
+        if isinstance(command, TimeSignature):
+            numerator, denominator = command.numerator, command.denominator
+            time_signature_events = it.time_signature_events
+
+            def run_time_signature() -> None:
+                time_signature_events.append(TimeSignatureEvent(it.current_time, numerator, denominator))
+                it.current_time_signature = (numerator, denominator)
+            return run_time_signature
+
+        elif isinstance(command, Tempo):
+            tempo = command.value
+            tempo_events = it.tempo_events
+
+            def run_tempo() -> None:
+                tempo_events.append(TempoEvent(it.current_time, tempo))
+                it.current_tempo = tempo
+            return run_tempo
+
+        elif isinstance(command, Pause):
+            # Pauses record a PauseEvent but do not advance time
+            get_duration = self.compile_duration(command.duration)
+            add_pause = it.events.add_pause
+
+            def run_pause() -> None:
+                add_pause(it.current_time, get_duration())
+            return run_pause
+
+        elif isinstance(command, Volume):
+            volume = it.current_volume
+            if command.value in it.volume_mapping:
+                vol_value = it.volume_mapping[command.value]
+                if vol_value == "diminuendo":
+                    # Handled during note generation, nothing to do here
+                    return None
+                level = cast(int, vol_value)
+            else:
+                level = 80  # mf
+
+            def run_volume() -> None:
+                volume[track_type] = level
+            return run_volume
+
+        elif isinstance(command, PianoNote):
+            return self.compile_note(
+                "piano", self.compile_duration(command.duration), self.compile_note_value(command.note)
+            )
+
+        elif isinstance(command, (GuitarNote, BassNote)):
+            instrument = "guitar" if isinstance(command, GuitarNote) else "bass"
+            base_notes = GUITAR_STRINGS if instrument == "guitar" else BASS_STRINGS
+            string_idx = min(command.string - 1, len(base_notes) - 1)
+            get_fret = self.compile_fret(command.fret)
+
+            def get_pitch() -> Any:
+                return base_notes[string_idx] + get_fret()
+            return self.compile_note(instrument, self.compile_duration(command.duration), get_pitch)
+
+        elif isinstance(command, ResolvedNote):
+            note_value = command.note_value
+            return self.compile_note(
+                command.instrument, self.compile_duration(command.duration), lambda: note_value
+            )
+
+        elif isinstance(command, DrumNote):
+            drum_type = command.drum_type
+            if drum_type in DRUM_TO_MIDI:
+                drum_note = DRUM_TO_MIDI[drum_type]
+
+                def get_drum() -> int:
+                    return drum_note
+            else:
+                def get_drum() -> int:
+                    print(f"Unknown drum type: {drum_type}, using KICK as default")
+                    return DRUM_TO_MIDI["KICK"]
+            return self.compile_note("drum", self.compile_duration(command.duration), get_drum)
+
+        elif isinstance(command, SyncBlock):
+            sub_commands = self.compile_block(command.commands, track_type)
+
+            def run_sync() -> None:
+                start_time = it.current_time
+                max_duration = 0.0
+                for sub_command in sub_commands:
+                    # Every command starts at the beginning of the sync block
+                    it.current_time = start_time
+                    sub_command()
+                    max_duration = max(max_duration, it.current_time - start_time)
+                it.current_time = start_time + max_duration
+            return run_sync
+
+        elif isinstance(command, ForLoop):
+            return self.compile_for_loop(command, track_type)
+
+        elif isinstance(command, Assignment):
+            return self.compile_assignment(command)
+
+        return None
+
+    def compile_note(self, instrument: str, get_duration: Callable[[], float],
+                     get_pitch: Callable[[], Any]) -> Callable[[], None]:
+        it = self.interpreter
+        add_note = it.events.add_note
+        volume = it.current_volume
+        channel = it.channels[instrument]
+
+        def run_note() -> None:
+            duration = get_duration()
+            note_value = get_pitch()
+            add_note(it.current_time, duration, note_value, volume[instrument], channel)
+            it.current_time += duration
+        return run_note
+
+    def compile_for_loop(self, command: ForLoop, track_type: str, stepwise: bool = False) -> Callable[[], Any]:
+        """Compile a for loop into a closure that runs it.
+
+        With stepwise=True the closure instead returns an iterator that runs
+        the loop and yields after every iteration, for Interpreter.iter_events.
+        """
+        it = self.interpreter
+        environment = it.environment
+        slots = environment.slots
+        var_name = command.var_name
+        var_slot = environment.slot(var_name)
+        init_value = command.init_value
+        condition = self.compile_expression(command.condition)
+        body = self.compile_block(command.body, track_type)
+        increment = self.compile_increment(command.incr_var, command.incr_op, command.incr_value)
+        max_iterations = 1000  # Safety limit
+        budget = it.budget
+        charge = it.charge if budget is not None else None
+        body_cost = sum(command_cost(body_command) for body_command in command.body)
+
+        if isinstance(init_value, str) and not SPN_VALUE_PATTERN.match(init_value):
+            init_slot = environment.slot(init_value)
+
+            def initialize() -> None:
+                value = slots[init_slot]
+                slots[var_slot] = 0 if value is UNDEFINED else value
+        elif isinstance(init_value, Expression):
+            get_init = self.compile_expression(init_value)
+
+            def initialize() -> None:
+                slots[var_slot] = get_init()
+        else:
+            def initialize() -> None:
+                slots[var_slot] = init_value
+
+        def iterate_for() -> Iterator[None]:
+            initialize()
+            iterations = 0
+            try:
+                while iterations < max_iterations and condition():
+                    if charge is not None:
+                        charge(body_cost)
+                    for body_command in body:
+                        body_command()
+                    increment()
+                    iterations += 1
+                    yield
+
+                if iterations >= max_iterations:
+                    print(f"Warning: Loop exceeded maximum iterations at position {it.current_time}")
+            except BudgetExceededError:
+                raise
+            except Exception as e:
+                print(f"Error in for loop execution: {e}")
+
+        def run_for() -> None:
+            for _ in iterate_for():
+                pass
+
+        reads = self.body_reads(command.body) if it.replicate_loops else None
+        if reads is None or var_name in reads or command.incr_var in reads:
+            return iterate_for if stepwise else run_for
+
+        events = it.events
+
+        def run_replicated() -> None:
+            # The body only emits events and advances time from state the
+            # loop never changes: run it once, then count the remaining
+            # iterations and append them as time-shifted copies
+            initialize()
+            iterations = 0
+            try:
+                if iterations < max_iterations and condition():
+                    if charge is not None:
+                        charge(body_cost)
+                    start_time = it.current_time
+                    first = len(events)
+                    for body_command in body:
+                        body_command()
+                    increment()
+                    iterations += 1
+                    end = len(events)
+                    period = it.current_time - start_time
+
+                    if events.block_is_exact(first, end, start_time, period, max_iterations):
+                        copies = 0
+                        try:
+                            while iterations < max_iterations and condition():
+                                if budget is not None:
+                                    # Charge for the copy before it exists
+                                    budget.charge(
+                                        body_cost,
+                                        len(events) + (copies + 1) * (end - first),
+                                        start_time + (copies + 2) * period,
+                                    )
+                                increment()
+                                iterations += 1
+                                copies += 1
+                        finally:
+                            events.repeat_block(first, end, copies, period)
+                            it.current_time = start_time + (copies + 1) * period
+                    else:
+                        while iterations < max_iterations and condition():
+                            if charge is not None:
+                                charge(body_cost)
+                            for body_command in body:
+                                body_command()
+                            increment()
+                            iterations += 1
+
+                if iterations >= max_iterations:
+                    print(f"Warning: Loop exceeded maximum iterations at position {it.current_time}")
+            except BudgetExceededError:
+                raise
+            except Exception as e:
+                print(f"Error in for loop execution: {e}")
+
+        read_slots = [environment.slot(name) for name in reads]
+
+        def run_for_loop() -> None:
+            # Missing variables print a warning per read, which copies would skip
+            if all(slots[i] is not UNDEFINED for i in read_slots):
+                run_replicated()
+            else:
+                run_for()
+
+        def iterate_for_loop() -> Iterator[None]:
+            if all(slots[i] is not UNDEFINED for i in read_slots):
+                run_replicated()
+                yield
+            else:
+                yield from iterate_for()
+        return iterate_for_loop if stepwise else run_for_loop
+
+    def body_reads(self, commands: List[Command]) -> Optional[set]:
+        """Variables a loop body reads, or None if it can do more than emit events.
+
+        A body qualifies when it only holds notes, pauses and sync blocks:
+        no assignments, nested loops, volume, tempo or time signature
+        changes, and nothing that prints a warning every time it runs.
+        """
+        reads: set = set()
+
+        def add_duration(duration: Any) -> bool:
+            if isinstance(duration, str):
+                reads.add(duration)
+                return True
+            return isinstance(duration, (int, float))
+
+        for command in commands:
+            if isinstance(command, (Pause, ResolvedNote)):
+                if not add_duration(command.duration):
+                    return None
+            elif isinstance(command, PianoNote):
+                note = command.note
+                if isinstance(note, str):
+                    match = re.match(r'([A-G][b#]?)(\d+)', note)
+                    if not match or match.end() != len(note):
+                        reads.add(note)
+                if not add_duration(command.duration):
+                    return None
+            elif isinstance(command, (GuitarNote, BassNote)):
+                if isinstance(command.fret, str):
+                    reads.add(command.fret)
+                if not add_duration(command.duration):
+                    return None
+            elif isinstance(command, DrumNote):
+                if command.drum_type not in DRUM_TO_MIDI or not add_duration(command.duration):
+                    return None
+            elif isinstance(command, SyncBlock):
+                nested = self.body_reads(command.commands)
+                if nested is None:
+                    return None
+                reads |= nested
+            else:
+                return None
+        return reads
+
+    def compile_increment(self, var_name: str, op: str, value: Any) -> Callable[[], None]:
+        environment = self.interpreter.environment
+        slots = environment.slots
+        var_slot = environment.slot(var_name)
+        get_value = self.compile_value(value)
+        apply = {
+            "++": lambda current: current + 1,
+            "--": lambda current: current - 1,
+            "+=": lambda current: current + get_value(),
+            "-=": lambda current: current - get_value(),
+            "*=": lambda current: current * get_value(),
+            "/=": lambda current: current / get_value(),
+            "=": lambda current: get_value(),
+        }.get(op)
+
+        def run_increment() -> None:
+            try:
+                current_value = slots[var_slot]
+                if current_value is UNDEFINED:
+                    current_value = 0  # Default if not defined
+                    slots[var_slot] = current_value
+
+                if apply is not None:
+                    slots[var_slot] = apply(current_value)
+                else:
+                    print(f"Unknown increment operator: {op}, using simple increment")
+                    slots[var_slot] = current_value + 1
+            except Exception as e:
+                print(f"Error in increment: {e}")
+        return run_increment
+
+    def compile_assignment(self, command: Assignment) -> Callable[[], None]:
+        environment = self.interpreter.environment
+        slots = environment.slots
+        name_slot = environment.slot(command.name)
+        op = command.operator
+
+        if op == "=":
+            value = command.value
+            if isinstance(value, Expression):
+                get_value = self.compile_expression(value)
+            elif isinstance(value, str) and not SPN_VALUE_PATTERN.match(value):
+                value_slot = environment.slot(value)
 
-# Note to MIDI mapping
-NOTE_TO_MIDI = {
-    'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3,
-    'E': 4, 'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8,
-    'A': 9, 'A#': 10, 'Bb': 10, 'B': 11
-}
+                # A variable if defined, otherwise the string itself
+                def get_value() -> Any:
+                    current = slots[value_slot]
+                    return value if current is UNDEFINED else current
+            else:
+                # Literals and notes (kept as their SPN string)
+                def get_value() -> Any:
+                    return value
+        else:
+            compiled_value = self.compile_value(command.value)
+            binary = BINARY_OPERATORS.get(op[:-1]) if op in ("+=", "-=", "*=", "/=") else None
 
-# Drum kit mapping (General MIDI)
-DRUM_TO_MIDI = {
-    'KICK': 36,
-    'SNARE': 38,
-    'HIHAT_CLOSED': 42,
-    'HIHAT_OPEN': 46,
-    'HIHAT_PEDAL': 44,
-    'RIDE': 51,
-    'CRASH': 49
-}
+            def get_value() -> Any:
+                current_value = slots[name_slot]
+                if current_value is UNDEFINED:
+                    current_value = 0
+                if binary is None:
+                    raise RuntimeError(f"Unsupported operator: {op}")
+                return binary(current_value, compiled_value())
 
-class Environment:
-    def __init__(self):
-        self.values: Dict[str, Any] = {}
-    
-    def define(self, name: str, value: Any) -> None:
-        self.values[name] = value
-    
-    def get(self, name: str) -> Any:
-        if name in self.values:
-            return self.values[name]
-        raise RuntimeError(f"Undefined variable '{name}'")
-    
-    def assign(self, name: str, value: Any) -> None:
-        if name in self.values:
-            self.values[name] = value
-            return
-        # Auto-define if not exists
-        self.values[name] = value
+        def run_assignment() -> None:
+            try:
+                slots[name_slot] = get_value()
+            except Exception as e:
+                print(f"Error in assignment: {e}")
+        return run_assignment
 
-class MusicEvent:
-    def __init__(self, start_time: float, duration: float):
-        self.start_time = start_time
-        self.duration = duration
+    def compile_duration(self, duration: Any) -> Callable[[], float]:
+        """Compiled equivalent of Interpreter.evaluate_duration"""
+        environment = self.interpreter.environment
+        slots = environment.slots
 
-class NoteEvent(MusicEvent):
-    def __init__(self, start_time: float, duration: float, note_value: int, velocity: int, channel: int):
-        super().__init__(start_time, duration)
-        self.note_value = note_value
-        self.velocity = velocity
-        self.channel = channel
+        if isinstance(duration, (int, float)):
+            constant = float(duration)
+            return lambda: constant
+        elif isinstance(duration, str):
+            try:
+                fallback: Optional[float] = float(duration)
+            except ValueError:
+                fallback = None
+            duration_slot = environment.slot(duration)
 
-class TimeSignatureEvent:
-    def __init__(self, time: float, numerator: int, denominator: int):
-        self.time = time
-        self.numerator = numerator
-        self.denominator = denominator
+            def get_duration() -> float:
+                value = slots[duration_slot]
+                if value is not UNDEFINED:
+                    return float(value)
+                if fallback is None:
+                    print(f"Invalid duration: {duration}, using 1.0 as default")
+                    return 1.0
+                return fallback
+            return get_duration
+        else:
+            def get_unexpected() -> float:
+                print(f"Unexpected duration type: {type(duration)}, using 1.0 as default")
+                return 1.0
+            return get_unexpected
 
-class TempoEvent:
-    def __init__(self, time: float, tempo: int):
-        self.time = time
-        self.tempo = tempo
+    def compile_note_value(self, note: Any) -> Callable[[], Any]:
+        """Compiled equivalent of Interpreter.evaluate_note"""
+        environment = self.interpreter.environment
+        slots = environment.slots
 
+        if not isinstance(note, str):
+            return lambda: note
+        note_slot = environment.slot(note)
 
-class PauseEvent(MusicEvent):
-    def __init__(self, start_time: float, duration: float):
-        super().__init__(start_time, duration)
+        match = re.match(r'([A-G][b#]?)(\d+)', note)
+        if match:
+            note_name, octave = match.groups()
+            if note_name not in NOTE_TO_MIDI:
+                # E#4, Cb4, ...: raise the lookup error when the command runs, as evaluate_note does
+                def get_unknown_note() -> Any:
+                    value = slots[note_slot]
+                    if value is UNDEFINED:
+                        return NOTE_TO_MIDI[note_name] + (int(octave) + 1) * 12
+                    return value
+                return get_unknown_note
+            resolved = NOTE_TO_MIDI[note_name] + (int(octave) + 1) * 12
+            if match.end() == len(note):
+                # A full SPN note can never be a variable name
+                return lambda: resolved
+
+            def get_note() -> Any:
+                value = slots[note_slot]
+                return resolved if value is UNDEFINED else value
+            return get_note
+
+        def get_variable_note() -> Any:
+            value = slots[note_slot]
+            if value is not UNDEFINED:
+                return value
+            print(f"Invalid note format: {note}, using C4 (60) as default")
+            return 60  # C4
+        return get_variable_note
+
+    def compile_fret(self, fret: Any) -> Callable[[], Any]:
+        environment = self.interpreter.environment
+        slots = environment.slots
+
+        if isinstance(fret, str):
+            fret_slot = environment.slot(fret)
+
+            def get_fret() -> Any:
+                value = slots[fret_slot]
+                # Default to open string if variable not found
+                return 0 if value is UNDEFINED else value
+            return get_fret
+        return lambda: fret
+
+    def compile_value(self, value: Any) -> Callable[[], Any]:
+        """Compiled equivalent of Interpreter.evaluate_value"""
+        environment = self.interpreter.environment
+        slots = environment.slots
+
+        if isinstance(value, Expression):
+            return self.compile_expression(value)
+        elif isinstance(value, str):
+            if SPN_VALUE_PATTERN.match(value):
+                return self.compile_note_value(value)
+            try:
+                fallback: Any = float(value)
+            except ValueError:
+                fallback = value
+            value_slot = environment.slot(value)
+
+            def get_value() -> Any:
+                current = slots[value_slot]
+                return fallback if current is UNDEFINED else current
+            return get_value
+        return lambda: value
+
+    def compile_expression(self, expr: Any) -> Callable[[], Any]:
+        """Compiled equivalent of Interpreter.evaluate"""
+        environment = self.interpreter.environment
+        slots = environment.slots
+
+        if isinstance(expr, Literal):
+            constant = expr.value
+            return lambda: constant
+        elif isinstance(expr, Variable):
+            name = expr.name
+            name_slot = environment.slot(name)
+
+            def get_variable() -> Any:
+                value = slots[name_slot]
+                if value is not UNDEFINED:
+                    return value
+                print(f"Undefined variable: {name}, using 0 as default")
+                return 0
+            return get_variable
+        elif isinstance(expr, BinaryExpr):
+            left = self.compile_expression(expr.left)
+            right = self.compile_expression(expr.right)
+            binary = BINARY_OPERATORS.get(expr.operator)
+            if binary is None:
+                operator_name = expr.operator
+
+                def get_unknown() -> Any:
+                    left()
+                    right()
+                    raise RuntimeError(f"Unknown operator: {operator_name}")
+                return get_unknown
+            if isinstance(expr.right, Literal):
+                constant = expr.right.value
+                return lambda: binary(left(), constant)
+            return lambda: binary(left(), right())
+        elif isinstance(expr, Grouping):
+            return self.compile_expression(expr.expression)
+
+        def get_invalid() -> Any:
+            raise RuntimeError(f"Unknown expression type: {expr}")
+        return get_invalid
 
 
 class Interpreter:
-    def __init__(self):
+    def __init__(self, compiled: bool = True, optimize: bool = True, replicate_loops: bool = True,
+                 budget: Optional[ExecutionBudget] = None, note_cache: Optional[NoteRenderCache] = None,
+                 synthesis: str = "additive", render_workers: Optional[int] = 1, normalize: str = "peak",
+                 profile: str = "final"):
+        if synthesis not in SYNTHESIS_MODES:
+            raise ValueError(f"Unknown synthesis mode: {synthesis!r} (expected one of {', '.join(SYNTHESIS_MODES)})")
+        if normalize not in NORMALIZE_MODES:
+            raise ValueError(f"Unknown normalize mode: {normalize!r} (expected one of {', '.join(NORMALIZE_MODES)})")
+        if not isinstance(profile, str) or profile not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile: {profile!r} (expected one of {', '.join(RENDER_PROFILES)})")
+        # Run tracks through TrackCompiler closures instead of execute_command
+        self.compiled = compiled
+        # Rewrite tracks with AstOptimizer before running them
+        self.optimize = optimize
+        # Let compiled loops emit time-invariant bodies as shifted copies
+        self.replicate_loops = replicate_loops
+        # Limits that abort interpretation with BudgetExceededError
+        self.budget = budget
+        # Rendered note buffers reused by synthesize_basic_wav
+        self.note_cache = note_cache if note_cache is not None else NoteRenderCache()
+        # How synthesize_basic_wav renders pitched notes (see SYNTHESIS_MODES)
+        self.synthesis = synthesis
+        # Processes synthesize_basic_wav mixes time shards in (None: one per CPU)
+        self.render_workers = render_workers
+        # How rendered audio is leveled (see NORMALIZE_MODES)
+        self.normalize = normalize
+        # Sample rate, synthesis and bitrate of rendered audio (see RENDER_PROFILES)
+        self.profile = RENDER_PROFILES[profile]
+        # Seconds spent per stage by the last convert_midi_to_mp3 call
+        self.stage_timings: Dict[str, float] = {}
         self.environment = Environment()
-        self.events: List[Union[MusicEvent, NoteEvent]] = []
+        self.events = EventStore()
         self.time_signature_events: List[TimeSignatureEvent] = []
         self.tempo_events: List[TempoEvent] = []
+        # (len(tempo_events), TempoMap) built by tempo_map()
+        self._tempo_map: Optional[Tuple[int, TempoMap]] = None
         
         # Default settings
         self.current_time = 0.0
@@ -986,22 +3299,183 @@ class Interpreter:
         }
     
     def interpret(self, tracks: List[Track]) -> None:
+        if self.budget is not None:
+            self.budget.start()
+        
+        if self.optimize:
+            optimizer = AstOptimizer()
+            tracks = [optimizer.optimize_track(track) for track in tracks]
+        
         for track in tracks:
-            # Reset environment for each track
-            self.environment = Environment()
+            # Reset environment for each track; compiled tracks resolve
+            # their variables to slots
+            self.environment = SlotEnvironment() if self.compiled else Environment()
             
             # Set initial track environment
             self.current_time = 0.0
             self.current_time_signature = (4, 4)
             
+            if self.compiled:
+                for run in TrackCompiler(self).compile_track(track):
+                    try:
+                        run()
+                    except BudgetExceededError:
+                        raise
+                    except Exception as e:
+                        print(f"Error executing command: {e}")
+                continue
+            
             # Process track commands
             for command in track.commands:
                 try:
                     self.execute_command(command, track.track_type)
+                except BudgetExceededError:
+                    raise
+                except Exception as e:
+                    print(f"Error executing command: {e}")
+    
+    def interpret_parallel(self, tracks: List[Track], max_workers: Optional[int] = None) -> None:
+        """Interpret each track in a worker process and merge the results.
+
+        Tracks are independent except for the volume levels a track inherits
+        from earlier tracks. Every worker first starts from this interpreter's
+        current volumes; tracks that may read an inherited level which an
+        earlier track changed are run once more with the serial start state.
+        Results are merged in track order, so events, tempo and time signature
+        events come out exactly as interpret() would produce them. A budget
+        is applied to each worker's track separately.
+        """
+        if len(tracks) < 2 or max_workers == 1:
+            self.interpret(tracks)
+            return
+        
+        initial_volume = dict(self.current_volume)
+        options = (self.compiled, self.optimize, self.replicate_loops, self.budget)
+        jobs = [(track, initial_volume, *options) for track in tracks]
+        
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(interpret_track_worker, jobs))
+            
+            # Replay the volume changes in track order to find each track's
+            # real start volume, and rerun the tracks that depend on it
+            reruns = {}
+            volume = dict(initial_volume)
+            for i, track in enumerate(tracks):
+                inherited = volume_reads_before_set(track)
+                if any(volume[name] != initial_volume[name] for name in inherited if name in volume):
+                    reruns[i] = pool.submit(
+                        interpret_track_worker, (track, dict(volume), *options)
+                    )
+                volume.update(results[i].volume_updates)
+            
+            for i, future in reruns.items():
+                results[i] = future.result()
+        
+        for result in results:
+            self.events.extend(result.events)
+            self.tempo_events.extend(TempoEvent(time, tempo) for time, tempo in result.tempo_events)
+            self.time_signature_events.extend(
+                TimeSignatureEvent(time, numerator, denominator)
+                for time, numerator, denominator in result.time_signature_events
+            )
+            if result.tempo_events:
+                self.current_tempo = result.tempo_events[-1][1]
+            self.current_volume.update(result.volume_updates)
+        
+        last = results[-1]
+        self.current_time = last.current_time
+        self.current_time_signature = last.current_time_signature
+        self.environment = Environment()
+        self.environment.values.update(last.variables)
+    
+    def iter_events(self, tracks: List[Track]) -> Iterator[MusicEvent]:
+        """Interpret the tracks lazily, yielding note and pause events by start time.
+
+        Every track runs on its own interpreter and is only advanced as far
+        as the merge needs: its events are released once the track's time
+        has passed them, at top-level commands and top-level loop iterations,
+        and a heap merges the tracks. Events come out in the order of a
+        stable sort of interpret()'s events by start time, but self.events
+        stays empty. Tempo, time signature, volume and the final track state
+        are merged into this interpreter once the iterator is exhausted.
+
+        Tracks that inherit a volume an earlier track may set, and the
+        tree-walking mode, are interpreted eagerly first. Negative durations
+        move time backwards and can yield an event out of order.
+        """
+        if not self.compiled or inherits_volume(tracks):
+            self.interpret(tracks)
+            events = self.events
+            yield from events.events_at(events.sorted_indices())
+            return
+        
+        if self.budget is not None:
+            self.budget.start()
+        
+        if self.optimize:
+            optimizer = AstOptimizer()
+            tracks = [optimizer.optimize_track(track) for track in tracks]
+        
+        cursors = []
+        for track in tracks:
+            # The cursors share this interpreter's budget
+            cursor = Interpreter(compiled=True, optimize=False, replicate_loops=self.replicate_loops,
+                                 budget=self.budget)
+            cursor.current_volume = VolumeRecorder(self.current_volume)
+            cursors.append(cursor)
+        
+        yield from heapq.merge(
+            *(cursor.iter_track_events(track) for cursor, track in zip(cursors, tracks)),
+            key=operator.attrgetter("start_time"),
+        )
+        
+        for cursor in cursors:
+            self.tempo_events.extend(cursor.tempo_events)
+            self.time_signature_events.extend(cursor.time_signature_events)
+            if cursor.tempo_events:
+                self.current_tempo = cursor.current_tempo
+            self.current_volume.update(cursor.current_volume.written)
+        
+        if cursors:
+            last = cursors[-1]
+            self.current_time = last.current_time
+            self.current_time_signature = last.current_time_signature
+            self.environment = last.environment
+    
+    def iter_track_events(self, track: Track) -> Iterator[MusicEvent]:
+        """Interpret a single track, yielding its events in start-time order"""
+        self.environment = SlotEnvironment()
+        self.current_time = 0.0
+        self.current_time_signature = (4, 4)
+        
+        for step in TrackCompiler(self).compile_steps(track):
+            iterations = step()
+            while True:
+                try:
+                    next(iterations)
+                except StopIteration:
+                    break
+                except BudgetExceededError:
+                    raise
                 except Exception as e:
                     print(f"Error executing command: {e}")
+                    break
+                # Nothing the track does later can start before current_time
+                released = self.events.pop_until(self.current_time)
+                if self.budget is not None:
+                    self.budget.released_events += len(released)
+                yield from released
+        
+        yield from self.events.pop_until(float("inf"))
+    
+    def charge(self, commands: int) -> None:
+        """Charge the budget for `commands` commands about to run"""
+        self.budget.charge(commands, len(self.events), self.current_time)
     
     def execute_command(self, command: Command, track_type: str) -> None:
+        if self.budget is not None:
+            self.charge(1)
+        
         if isinstance(command, TimeSignature):
             self.time_signature_events.append(
                 TimeSignatureEvent(self.current_time, command.numerator, command.denominator)
@@ -1092,6 +3566,23 @@ class Interpreter:
             # Move time forward
             self.current_time += duration
         
+        elif isinstance(command, ResolvedNote):
+            duration = self.evaluate_duration(command.duration)
+            
+            # Pitch was already resolved by the optimizer
+            self.events.append(
+                NoteEvent(
+                    self.current_time, 
+                    duration, 
+                    command.note_value, 
+                    self.current_volume[command.instrument], 
+                    self.channels[command.instrument]
+                )
+            )
+            
+            # Move time forward
+            self.current_time += duration
+        
         elif isinstance(command, DrumNote):
             duration = self.evaluate_duration(command.duration)
             
@@ -1151,6 +3642,8 @@ class Interpreter:
                     else:
                         init_value = 0  # Default if variable not found
                     self.environment.define(command.var_name, init_value)
+            elif isinstance(command.init_value, Expression):  # Pre-resolved by the optimizer
+                self.environment.define(command.var_name, self.evaluate(command.init_value))
             else:  # It's a literal
                 self.environment.define(command.var_name, command.init_value)
             
@@ -1170,6 +3663,8 @@ class Interpreter:
                     
                 if iterations >= max_iterations:
                     print(f"Warning: Loop exceeded maximum iterations at position {self.current_time}")
+            except BudgetExceededError:
+                raise
             except Exception as e:
                 print(f"Error in for loop execution: {e}")
         
@@ -1330,11 +3825,22 @@ class Interpreter:
         except Exception as e:
             print(f"Error in increment: {e}")
     
-    def generate_midi(self, filename: str) -> None:
-        # Create MIDIFile with correct tracks
-        # Use a simple approach: one track per channel
-        num_tracks = 4  # piano, guitar, bass, drum
-        midi = MIDIFile(num_tracks)
+    def generate_midi(self, target: Union[str, BinaryIO]) -> None:
+        """Write the MIDI file to a path or to any binary file-like object"""
+        if isinstance(target, str):
+            with open(target, "wb") as output_file:
+                self.build_midi().write(output_file)
+        else:
+            self.build_midi().write(target)
+    
+    def midi_bytes(self) -> bytes:
+        """The MIDI file as bytes, without touching the filesystem"""
+        return self.build_midi().to_bytes()
+    
+    def build_midi(self) -> MidiWriter:
+        # One track per instrument: piano, guitar, bass, drum
+        num_tracks = 4
+        midi = MidiWriter(num_tracks)
         
         # Set up instruments for each track
         track_map = {
@@ -1347,249 +3853,281 @@ class Interpreter:
         # Set instruments for each track
         for track_num, track_info in track_map.items():
             if track_info["program"] is not None:  # Skip drums
-                # Changed from named parameters to positional parameters
-                # Order: tracknum, channel, time, program
-                midi.addProgramChange(track_num, track_info["channel"], 0, track_info["program"])
+                midi.add_program_change(track_num, track_info["channel"], 0, track_info["program"])
+        
+        tempo_map = self.tempo_map()
         
         # Add tempo events
         if self.tempo_events:
             for tempo_event in self.tempo_events:
-                midi.addTempo(0, self.time_to_beats(tempo_event.time), tempo_event.tempo)
+                midi.add_tempo(tempo_map.time_to_beats(tempo_event.time), tempo_event.tempo)
         else:
             # Default tempo if none specified
-            midi.addTempo(0, 0, 120)
-        
-        # Add note events
-        for event in self.events:
-            if isinstance(event, NoteEvent):
-                # Map channel to track
-                track = event.channel
-                if track == 9:  # Drum channel
-                    track = 3  # Use track 3 for drums
-                
-                # Convert to beats
-                start_time_beats = self.time_to_beats(event.start_time)
-                duration_beats = self.duration_to_beats(event.duration, event.start_time)
-                
-                # Ensure non-negative duration
-                if duration_beats <= 0:
-                    duration_beats = 0.25  # Default to a sixteenth note
-                
-                # Add note to MIDI file - using positional parameters
-                try:
-                    # Order: track, channel, pitch, time, duration, volume
-                    midi.addNote(
-                        track,
-                        event.channel,
-                        event.note_value,
-                        start_time_beats,
-                        duration_beats,
-                        event.velocity
-                    )
-                except Exception as e:
-                    print(f"Error adding note: {e}")
-                    print(f"Track: {track}, Channel: {event.channel}, Pitch: {event.note_value}")
-                    print(f"Time: {start_time_beats}, Duration: {duration_beats}")
+            midi.add_tempo(0, 120)
+        
+        # Add note events, converted to beats in one pass over the columns
+        events = self.events
+        notes = events.note_indices()
+        start_times = events.start[notes]
+        start_beats = tempo_map.times_to_beats(start_times)
+        duration_beats = tempo_map.durations_to_beats(events.duration[notes], start_times)
+        # Ensure non-negative duration, defaulting to a sixteenth note
+        duration_beats = np.where(duration_beats <= 0, 0.25, duration_beats)
+        channels = events.channel[notes].astype(np.int64)
+        # Map channel to track, with the drum channel on track 3
+        tracks = np.where(channels == 9, 3, channels)
+        
+        # Only whole MIDI note numbers can be written
+        pitches = events.pitch[notes]
+        valid = (pitches >= 0) & (pitches <= 127) & (pitches == np.floor(pitches))
+        if events.raw_pitches:
+            valid &= ~np.isin(notes, list(events.raw_pitches))
+        for i in np.flatnonzero(~valid).tolist():
+            note_value = events.pitch_values(notes[i:i + 1])[0]
+            print(f"Error adding note: invalid MIDI pitch {note_value!r}")
+            print(f"Track: {tracks[i]}, Channel: {channels[i]}, Pitch: {note_value}")
+            print(f"Time: {start_beats[i]}, Duration: {duration_beats[i]}")
         
-        # Write the MIDI file
-        with open(filename, "wb") as output_file:
-            midi.writeFile(output_file)
+        midi.add_notes(
+            tracks[valid], channels[valid], pitches[valid].astype(np.int64),
+            start_beats[valid], duration_beats[valid], events.velocity[notes][valid].astype(np.int64)
+        )
+        return midi
+    
+    def tempo_map(self) -> TempoMap:
+        """TempoMap of every tempo change the interpreter recorded"""
+        # tempo_events only ever grows, so its length identifies the map
+        cached = self._tempo_map
+        if cached is None or cached[0] != len(self.tempo_events):
+            cached = self._tempo_map = (len(self.tempo_events), TempoMap(self.tempo_events))
+        return cached[1]
     
     def time_to_beats(self, time: float) -> float:
-        # Simple conversion using current tempo
-        return time * self.current_tempo / 60.0
+        return self.tempo_map().time_to_beats(time)
     
     def duration_to_beats(self, duration: float, start_time: float) -> float:
-        # Simple conversion using current tempo
-        return duration * self.current_tempo / 60.0
+        return self.tempo_map().duration_to_beats(duration, start_time)
     
-    def synthesize_basic_wav(self, wav_file_path: str) -> None:
-        """Generate a WAV file with clearly audible tones"""
-        # Basic parameters
-        sample_rate = 44100
-        max_amplitude = 32767  # 16-bit
-        
-        # Create an empty audio buffer
-        duration = max((event.start_time + event.duration for event in self.events 
-                    if isinstance(event, NoteEvent)), default=10.0)  # Default duration if no events
-        num_samples = int(duration * sample_rate)
-        audio_data = np.zeros(num_samples, dtype=np.float32)
-        
-        # Generate waveforms for each note
-        for event in self.events:
-            if isinstance(event, NoteEvent):
-                start_sample = int(event.start_time * sample_rate)
-                end_sample = int((event.start_time + event.duration) * sample_rate)
-                
-                if start_sample >= num_samples:
-                    continue
-                
-                end_sample = min(end_sample, num_samples)
-                sample_count = end_sample - start_sample
-                
-                if sample_count <= 0:
-                    continue  # Skip empty notes
-                    
-                # Get frequency from MIDI note
-                frequency = 440.0 * (2.0 ** ((event.note_value - 69) / 12.0))
-                
-                # Generate samples - use a mix of sine wave and sawtooth for more presence
-                t = np.linspace(0, event.duration, sample_count, endpoint=False)
-                
-                # Different waveform based on instrument type
-                if event.channel == 9:  # Drums
-                    # Percussion sounds - more noise components
-                    if event.note_value == 36:  # Kick
-                        # Low frequency sine with quick decay
-                        signal = np.sin(2.0 * np.pi * frequency * t) + 0.5 * np.sin(2.0 * np.pi * (frequency/2) * t)
-                        envelope = np.exp(-5 * t/event.duration)
-                    elif event.note_value == 38:  # Snare
-                        # Mix of sine and noise
-                        noise = np.random.uniform(-0.5, 0.5, size=sample_count)
-                        signal = 0.5 * np.sin(2.0 * np.pi * frequency * t) + 0.5 * noise
-                        envelope = np.exp(-8 * t/event.duration)
-                    else:  # Other percussion
-                        # Mostly noise with some tone
-                        noise = np.random.uniform(-0.7, 0.7, size=sample_count)
-                        signal = 0.3 * np.sin(2.0 * np.pi * frequency * t) + 0.7 * noise
-                        envelope = np.exp(-10 * t/event.duration)
-                elif event.channel == 0:  # Piano
-                    # Rich harmonics for piano
-                    signal = np.sin(2.0 * np.pi * frequency * t)
-                    signal += 0.5 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
-                    signal += 0.3 * np.sin(2.0 * np.pi * 3 * frequency * t)  # 2nd harmonic
-                    
-                    # Piano-like envelope with sharp attack and gradual decay
-                    attack = int(0.01 * sample_count)
-                    decay = sample_count - attack
-                    envelope = np.ones(sample_count)
-                    if attack > 0:
-                        envelope[:attack] = np.linspace(0, 1, attack)
-                    if decay > 0:
-                        envelope[attack:] = np.exp(-3 * np.linspace(0, 1, decay))
-                elif event.channel == 1:  # Guitar
-                    # Guitar-like sound with rich harmonics
-                    signal = np.sin(2.0 * np.pi * frequency * t)
-                    signal += 0.5 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
-                    signal += 0.2 * np.sin(2.0 * np.pi * 3 * frequency * t)  # 2nd harmonic
-                    
-                    # Add slight distortion for character
-                    signal = np.tanh(1.5 * signal)
-                    
-                    # Guitar-like envelope with quick attack and longer sustain
-                    attack = int(0.005 * sample_count)
-                    decay = int(0.1 * sample_count)
-                    sustain = sample_count - attack - decay
-                    
-                    envelope = np.ones(sample_count)
-                    if attack > 0:
-                        envelope[:attack] = np.linspace(0, 1, attack)
-                    if decay > 0 and sustain > 0:
-                        envelope[attack:attack+decay] = np.linspace(1, 0.7, decay)
-                        envelope[attack+decay:] = np.linspace(0.7, 0.5, sustain)
-                elif event.channel == 2:  # Bass
-                    # Bass sound with more fundamental and less harmonics
-                    signal = np.sin(2.0 * np.pi * frequency * t)
-                    signal += 0.3 * np.sin(2.0 * np.pi * 2 * frequency * t)  # 1st harmonic
-                    
-                    # Add some warmth with soft clipping
-                    signal = np.tanh(1.2 * signal)
-                    
-                    # Bass-like envelope with medium attack and long sustain
-                    attack = int(0.01 * sample_count)
-                    decay = int(0.1 * sample_count)
-                    sustain = sample_count - attack - decay
-                    
-                    envelope = np.ones(sample_count)
-                    if attack > 0:
-                        envelope[:attack] = np.linspace(0, 1, attack)
-                    if decay > 0 and sustain > 0:
-                        envelope[attack:attack+decay] = np.linspace(1, 0.8, decay)
-                        envelope[attack+decay:] = np.linspace(0.8, 0.6, sustain)
-                else:
-                    # Default instrument sound
-                    signal = np.sin(2.0 * np.pi * frequency * t)
-                    envelope = np.exp(-3 * t/event.duration)
-                
-                # Apply velocity scaling
-                velocity_factor = event.velocity / 127.0
-                
-                # Apply envelope and velocity
-                samples = signal * envelope * velocity_factor
-                
-                # Scale to avoid clipping
-                samples = samples * 0.5
-                
-                # Add to audio buffer
-                audio_data[start_sample:end_sample] += samples
+    def resolve_profile(self, profile: Optional[str] = None) -> RenderProfile:
+        """The named RENDER_PROFILES entry, or the interpreter's own profile for None"""
+        if profile is None:
+            return self.profile
+        if not isinstance(profile, str) or profile not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile: {profile!r} (expected one of {', '.join(RENDER_PROFILES)})")
+        return RENDER_PROFILES[profile]
+    
+    def audio_sample_count(self, profile: Optional[RenderProfile] = None) -> int:
+        """Length of the synthesized audio in samples"""
+        profile = profile or self.profile
+        duration = self.events.end_time(self.events.note_indices(), default=10.0)  # Default duration if no events
+        return int(duration * profile.sample_rate)
+    
+    def audio_voices(self, profile: Optional[RenderProfile] = None) -> List[Voice]:
+        """The notes to synthesize as sample spans, sorted by start sample"""
+        profile = profile or self.profile
+        events = self.events
+        notes = events.note_indices()
+        num_samples = self.audio_sample_count(profile)
         
-        # Normalize to prevent clipping
-        max_val = np.max(np.abs(audio_data))
-        if max_val > 0:
-            audio_data = audio_data / max_val * 0.9  # Leave some headroom
+        # Note spans in samples, clipped to the end of the song
+        start_samples = (events.start[notes] * profile.sample_rate).astype(np.int64)
+        end_samples = ((events.start[notes] + events.duration[notes]) * profile.sample_rate).astype(np.int64)
+        np.minimum(end_samples, num_samples, out=end_samples)
+        playable = np.flatnonzero((start_samples < num_samples) & (end_samples > start_samples))
+        order = playable[np.argsort(start_samples[playable], kind="stable")].tolist()
         
-        # Apply a gentle limiter to prevent clipping
-        audio_data = np.tanh(audio_data)
+        start_list = start_samples.tolist()
+        end_list = end_samples.tolist()
+        durations = events.duration[notes].tolist()
+        pitches = events.pitch_values(notes)
+        velocities = events.velocity[notes].tolist()
+        channels = events.channel[notes].tolist()
+        return [(i, start_list[i], end_list[i], channels[i], pitches[i], durations[i], velocities[i])
+                for i in order]
+    
+    def iter_audio_blocks(self, block_samples: int = AUDIO_BLOCK_SAMPLES, master: bool = False,
+                          profile: Optional[RenderProfile] = None) -> Iterator[np.ndarray]:
+        """Synthesize the song as consecutive int16 blocks of `block_samples` samples.
+
+        Time is swept block by block (see mix_audio_blocks). With the "peak"
+        normalize mode each mixed float32 block is spilled to a temporary
+        file while tracking the peak, then read back, normalized and
+        converted, so memory stays at O(block + active voices) however long
+        the song is. The "limiter" mode needs no second pass: blocks go
+        through a LookaheadLimiter and come out a short delay later, sized
+        as the limiter releases them. With `master` the blocks also get the
+        MP3 loudness stages (see master_pcm). `profile` defaults to the
+        interpreter's.
+        """
+        profile = profile or self.profile
+        num_samples = self.audio_sample_count(profile)
+        blocks = mix_audio_blocks(self.audio_voices(profile), 0, num_samples, block_samples, self.note_cache,
+                                  profile.synthesis or self.synthesis, profile.sample_rate)
+        if self.normalize == "limiter":
+            yield from limited_pcm_blocks(blocks, master, profile.sample_rate)
+            return
+        with tempfile.TemporaryFile() as spill:
+            peak = spill_audio_blocks(blocks, spill)
+            spill.seek(0)
+            yield from pcm_blocks(spilled_blocks(spill, num_samples, block_samples), peak, master)
+    
+    def iter_audio_blocks_parallel(self, max_workers: Optional[int] = None,
+                                   block_samples: int = AUDIO_BLOCK_SAMPLES, master: bool = False,
+                                   profile: Optional[RenderProfile] = None) -> Iterator[np.ndarray]:
+        """iter_audio_blocks, with the mixing spread over a process pool.
+
+        The timeline is cut into time shards, a few per worker so uneven
+        note density still balances. Each worker mixes one shard into its
+        own spill file, re-rendering the notes that reach into the shard
+        from earlier ones, and reports the shard's peak. Normalization then
+        uses the global peak while the shards are read back in order, so
+        pitched notes come out sample-identical to iter_audio_blocks.
+        """
+        profile = profile or self.profile
+        num_samples = self.audio_sample_count(profile)
+        workers = max_workers or os.cpu_count() or 1
+        shard_count = min(workers * 4, -(-num_samples // (MIN_SHARD_SECONDS * profile.sample_rate)))
+        if workers == 1 or shard_count < 2:
+            yield from self.iter_audio_blocks(block_samples, master, profile)
+            return
         
-        # Convert to 16-bit PCM
-        audio_data = (audio_data * max_amplitude).astype(np.int16)
+        voices = self.audio_voices(profile)
+        starts = np.array([voice[1] for voice in voices], dtype=np.int64)
+        ends = np.array([voice[2] for voice in voices], dtype=np.int64)
+        bounds = [num_samples * k // shard_count for k in range(shard_count + 1)]
+        synthesis = profile.synthesis or self.synthesis
         
-        # Write WAV file
-        with wave.open(wav_file_path, 'w') as wav_file_obj:
-            wav_file_obj.setnchannels(1)  # Mono
-            wav_file_obj.setsampwidth(2)  # 16-bit
-            wav_file_obj.setframerate(sample_rate)
-            wav_file_obj.writeframes(audio_data.tobytes())
+        with tempfile.TemporaryDirectory() as spill_dir:
+            jobs = []
+            for k, (first, last) in enumerate(zip(bounds, bounds[1:])):
+                # Notes starting before the shard ends that are still sounding at its start
+                candidates = int(np.searchsorted(starts, last))
+                overlapping = np.flatnonzero(ends[:candidates] > first).tolist()
+                jobs.append(([voices[i] for i in overlapping], first, last, block_samples,
+                             synthesis, profile.sample_rate, os.path.join(spill_dir, f"shard{k}.f32")))
+            
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                peaks = list(pool.map(synthesize_shard_worker, jobs))
+            peak = max(peaks)
+            
+            def shard_blocks() -> Iterator[np.ndarray]:
+                for job in jobs:
+                    with open(job[-1], "rb") as spill:
+                        yield from spilled_blocks(spill, job[2] - job[1], block_samples)
+            
+            if self.normalize == "limiter":
+                yield from limited_pcm_blocks(shard_blocks(), master, profile.sample_rate)
+            else:
+                yield from pcm_blocks(shard_blocks(), peak, master)
+    
+    def audio_blocks(self, block_samples: int = AUDIO_BLOCK_SAMPLES, master: bool = False,
+                     profile: Optional[RenderProfile] = None) -> Iterator[np.ndarray]:
+        """int16 blocks from the serial or sharded renderer, per render_workers"""
+        if self.render_workers == 1:
+            return self.iter_audio_blocks(block_samples, master, profile)
+        return self.iter_audio_blocks_parallel(self.render_workers, block_samples, master, profile)
+    
+    def synthesize_basic_wav(self, wav_file_path: Union[str, BinaryIO],
+                             block_samples: int = AUDIO_BLOCK_SAMPLES, master: bool = False,
+                             profile: Optional[str] = None) -> None:
+        """Generate a WAV file with clearly audible tones"""
+        render = self.resolve_profile(profile)
+        write_wav(wav_file_path, self.audio_sample_count(render), self.audio_blocks(block_samples, master, render),
+                  render.sample_rate)
+    
+    def synthesize_pcm(self, master: bool = False, profile: Optional[RenderProfile] = None) -> bytes:
+        """The synthesized mono 16-bit PCM samples, in memory"""
+        return b"".join(block.tobytes() for block in self.audio_blocks(master=master, profile=profile))
     
-    def convert_midi_to_mp3(self, midi_file: str, mp3_file: str) -> None:
+    def encode_mp3(self, output: BinaryIO, command: Optional[List[str]] = None,
+                   profile: Optional[RenderProfile] = None) -> None:
+        """Stream mastered PCM blocks through a StreamingEncoder into `output`.
+
+        Encoding overlaps with producing the blocks. With "peak" normalization
+        that is only the renderer's second pass (read back, normalize,
+        master), since the song's peak must be known first; with "limiter"
+        it overlaps the mixing itself.
+        """
+        profile = profile or self.profile
+        command = command or encoder_command(profile.bitrate_kbps, profile.sample_rate)
+        with StreamingEncoder(output, command) as encoder:
+            for block in self.audio_blocks(master=True, profile=profile):
+                encoder.write(block)
+    
+    def convert_midi_to_mp3(self, midi_file: Optional[str], mp3_file: str, profile: Optional[str] = None) -> None:
         """
         Convert a MIDI file to MP3 using direct synthesis
+        
+        The mastered PCM goes from memory straight to the encoder: normalize
+        and the +6 dB gain are applied in memory, and no WAV is written or
+        decoded in between. With ffmpeg or lame installed, blocks are piped to
+        it as they are rendered (see encode_mp3). Otherwise the song is
+        rendered once, and the WAV fallback reuses that render. Stage durations
+        land in stage_timings. `profile` picks a RENDER_PROFILES entry for
+        this call, e.g. "preview" for fast, low-fidelity IDE runs.
+        `midi_file` is only named when synthesis fails; pass None when the
+        MIDI data was not written to disk.
         """
-        # Generate a WAV file directly from our events
-        temp_wav = tempfile.mktemp(suffix=".wav")
+        render = self.resolve_profile(profile)
+        self.stage_timings = {}
+        if encoder_command() is not None:
+            started = time.perf_counter()
+            try:
+                print("Generating audio and streaming it to the MP3 encoder...")
+                with open(mp3_file, "wb") as output:
+                    self.encode_mp3(output, profile=render)
+                self.stage_timings["synthesis+encode"] = time.perf_counter() - started
+                print(f"Successfully generated MP3 file: {mp3_file}")
+                return
+            except Exception as e:
+                print(f"Error streaming to MP3 encoder: {e}")
+                if os.path.exists(mp3_file):
+                    os.remove(mp3_file)
         
         try:
+            from pydub import AudioSegment
+        except ImportError:
+            AudioSegment = None
+        
+        try:
+            wav_output = mp3_file.replace(".mp3", ".wav")
             print("Generating audio...")
-            self.synthesize_basic_wav(temp_wav)
+            started = time.perf_counter()
+            if AudioSegment is None:
+                print("pydub not available, using WAV instead")
+                # Plain normalized audio: the +6 dB mastering is only for the MP3
+                self.synthesize_basic_wav(wav_output, profile=render.name)
+                self.stage_timings["synthesis"] = time.perf_counter() - started
+                print(f"Generated WAV file instead: {wav_output}")
+                return
+            # Rendered once, unmastered, so the WAV fallback can reuse it;
+            # master_pcm works sample by sample, so mastering afterwards
+            # gives the same PCM as mastering each block
+            pcm = np.frombuffer(self.synthesize_pcm(profile=render), dtype=np.int16)
+            self.stage_timings["synthesis"] = time.perf_counter() - started
             
-            # Try to convert WAV to MP3 if pydub is available
+            started = time.perf_counter()
             try:
-                from pydub import AudioSegment
                 print(f"Converting WAV to MP3...")
-                audio = AudioSegment.from_file(temp_wav, format="wav")
-                
-                # Normalize and boost volume to ensure audibility
-                audio = audio.normalize()
-                audio = audio + 6  # Add 6 dB of gain
+                audio = AudioSegment(data=master_pcm(pcm).tobytes(), sample_width=2,
+                                     frame_rate=render.sample_rate, channels=1)
                 
                 # Export to MP3
-                audio.export(mp3_file, format="mp3", bitrate="192k")
+                audio.export(mp3_file, format="mp3", bitrate=f"{render.bitrate_kbps}k")
                 print(f"Successfully generated MP3 file: {mp3_file}")
-            except ImportError:
-                print("pydub not available, using WAV instead")
-                # Copy the WAV file instead
-                import shutil
-                wav_output = mp3_file.replace(".mp3", ".wav")
-                shutil.copy(temp_wav, wav_output)
-                print(f"Generated WAV file instead: {wav_output}")
             except Exception as e:
                 print(f"Error converting to MP3: {e}")
-                # Fall back to keeping the WAV file
-                import shutil
-                wav_output = mp3_file.replace(".mp3", ".wav")
-                shutil.copy(temp_wav, wav_output)
+                # Fall back to the WAV file
+                write_wav(wav_output, len(pcm), [pcm], render.sample_rate)
                 print(f"Provided WAV file instead: {wav_output}")
+            self.stage_timings["encode"] = time.perf_counter() - started
         except Exception as e:
             print(f"Error in audio synthesis: {e}")
             # Just keep the MIDI file
-            print(f"Audio synthesis failed. Generated MIDI file only: {midi_file}")
-        finally:
-            # Clean up temp files
-            if os.path.exists(temp_wav):
-                try:
-                    os.remove(temp_wav)
-                except:
-                    pass
+            if midi_file is not None:
+                print(f"Audio synthesis failed. Generated MIDI file only: {midi_file}")
+            else:
+                print("Audio synthesis failed.")
     
     def generate_vexflow_data(self, filename: str) -> None:
         """Generate JSON data for VexFlow sheet music rendering"""
@@ -1598,16 +4136,11 @@ class Interpreter:
         print(f"Total events to process: {len(self.events)}")
         
         # Group events by channel/instrument and include pauses
-        events_by_channel = {}
-        pause_events = []
-        
-        for event in self.events:
-            if isinstance(event, NoteEvent):
-                if event.channel not in events_by_channel:
-                    events_by_channel[event.channel] = []
-                events_by_channel[event.channel].append(event)
-            elif isinstance(event, PauseEvent):
-                pause_events.append(event)
+        events_by_channel = {
+            channel: self.events.events_at(self.events.channel_indices(channel))
+            for channel in self.events.note_channels()
+        }
+        pause_events = self.events.events_at(self.events.pause_indices())
         
         print(f"Events grouped by channel: {list(events_by_channel.keys())}")
         print(f"Pause events found: {len(pause_events)}")
@@ -1620,11 +4153,17 @@ class Interpreter:
             9: {"name": "Drums", "clef": "percussion", "color": "#C73E1D"}
         }
         
+        tempo_map = self.tempo_map()
+        
         # Prepare the data structure for VexFlow
         sheet_data = {
             "title": "Nyan Cat Music",
             "composer": "Music DSL",
             "tempo": self.tempo_events[0].tempo if self.tempo_events else 120,
+            "tempo_map": [
+                {"time": time, "beat": beat, "tempo": tempo}
+                for time, beat, tempo in zip(tempo_map.times, tempo_map.beat_offsets, tempo_map.tempos)
+            ],
             "time_signature": f"{self.current_time_signature[0]}/{self.current_time_signature[1]}",
             "key_signature": "B",
             "staves": []
@@ -1669,6 +4208,7 @@ class Interpreter:
                         "duration": duration,
                         "velocity": 0,  # Rests have no velocity
                         "start_time": event.start_time,
+                        "start_beat": tempo_map.time_to_beats(event.start_time),
                         "midi_note": -1,  # Special value for rests
                         "is_rest": True
                     }
@@ -1682,6 +4222,7 @@ class Interpreter:
                         "duration": duration,
                         "velocity": event.velocity,
                         "start_time": event.start_time,
+                        "start_beat": tempo_map.time_to_beats(event.start_time),
                         "midi_note": event.note_value,
                         "is_rest": False
                     }
@@ -2259,13 +4800,139 @@ class Interpreter:
         with open(html_filename, 'w') as f:
             f.write(html_content)
 
+##############################
+# PARALLEL INTERPRETATION
+##############################
+
+class VolumeRecorder(dict):
+    """Volume dict that remembers which instruments a track set"""
+
+    def __init__(self, *args: Any):
+        super().__init__(*args)
+        self.written: Dict[str, int] = {}
+
+    def __setitem__(self, key: str, value: int) -> None:
+        super().__setitem__(key, value)
+        self.written[key] = value
+
+@dataclass
+class TrackResult:
+    """Everything interpret_parallel needs back from one track's worker"""
+    events: "EventStore"
+    tempo_events: List[Tuple[float, int]]
+    time_signature_events: List[Tuple[float, int, int]]
+    volume_updates: Dict[str, int]
+    current_time: float
+    current_time_signature: Tuple[int, int]
+    variables: Dict[str, Any]
+
+def interpret_track_worker(job: Tuple[Track, Dict[str, int], bool, bool, bool, Optional[ExecutionBudget]]) -> TrackResult:
+    """Process pool entry point: interpret a single track from a given volume state"""
+    track, start_volume, compiled, optimize, replicate_loops, budget = job
+    interpreter = Interpreter(compiled=compiled, optimize=optimize, replicate_loops=replicate_loops,
+                              budget=budget)
+    interpreter.current_volume = VolumeRecorder(start_volume)
+    interpreter.interpret([track])
+    
+    return TrackResult(
+        events=interpreter.events,
+        tempo_events=[(e.time, e.tempo) for e in interpreter.tempo_events],
+        time_signature_events=[(e.time, e.numerator, e.denominator) for e in interpreter.time_signature_events],
+        volume_updates=dict(interpreter.current_volume.written),
+        current_time=interpreter.current_time,
+        current_time_signature=interpreter.current_time_signature,
+        variables=dict(interpreter.environment.values),
+    )
+
+# Note cache of a render worker process, kept across the shards it mixes
+worker_note_cache: Optional[NoteRenderCache] = None
+
+def synthesize_shard_worker(job: Tuple[List[Voice], int, int, int, str, int, str]) -> np.float32:
+    """Process pool entry point: mix one time shard into a spill file, return its peak"""
+    global worker_note_cache
+    voices, first_sample, last_sample, block_samples, synthesis, sample_rate, spill_path = job
+    if worker_note_cache is None:
+        worker_note_cache = NoteRenderCache()
+    blocks = mix_audio_blocks(voices, first_sample, last_sample, block_samples, worker_note_cache, synthesis,
+                              sample_rate)
+    with open(spill_path, "wb") as spill:
+        return spill_audio_blocks(blocks, spill)
+
+NOTE_INSTRUMENTS: Dict[type, str] = {
+    PianoNote: "piano",
+    GuitarNote: "guitar",
+    BassNote: "bass",
+    DrumNote: "drum",
+}
+
+def volume_writes(track: Track) -> set:
+    """Instruments whose volume the track may set, anywhere in it"""
+    def writes(commands: List[Command]) -> bool:
+        for command in commands:
+            if isinstance(command, Volume) and command.value != "diminuendo":
+                return True
+            if isinstance(command, SyncBlock) and writes(command.commands):
+                return True
+            if isinstance(command, ForLoop) and writes(command.body):
+                return True
+        return False
+
+    return {track.track_type} if writes(track.commands) else set()
+
+def inherits_volume(tracks: List[Track]) -> bool:
+    """True if a track may read a volume level that an earlier track set"""
+    written: set = set()
+    for track in tracks:
+        if volume_reads_before_set(track) & written:
+            return True
+        written |= volume_writes(track)
+    return False
+
+def volume_reads_before_set(track: Track) -> set:
+    """Instruments whose volume the track may read before setting it itself.
+
+    Only top-level Volume commands count as set: they cannot fail, whereas a
+    Volume inside a sync block or loop may be skipped by an earlier error or
+    a loop that never runs. Over-reporting only costs an extra rerun.
+    """
+    reads: set = set()
+
+    def walk(commands: List[Command], already_set: set, top_level: bool) -> None:
+        for command in commands:
+            if isinstance(command, Volume):
+                if top_level and command.value != "diminuendo":
+                    already_set.add(track.track_type)
+            elif isinstance(command, ResolvedNote):
+                if command.instrument not in already_set:
+                    reads.add(command.instrument)
+            elif type(command) in NOTE_INSTRUMENTS:
+                if NOTE_INSTRUMENTS[type(command)] not in already_set:
+                    reads.add(NOTE_INSTRUMENTS[type(command)])
+            elif isinstance(command, SyncBlock):
+                walk(command.commands, set(already_set), False)
+            elif isinstance(command, ForLoop):
+                walk(command.body, set(already_set), False)
+
+    walk(track.commands, set(), True)
+    return reads
+
+
 ##############################
 # MAIN SCRIPT
 ##############################
 
 def main() -> None:
+    if len(sys.argv) == 3 and sys.argv[1] == "--build-cache":
+        if not os.path.isdir(sys.argv[2]):
+            print(f"Directory not found: {sys.argv[2]}")
+            return
+        built = build_ast_caches(sys.argv[2])
+        print(f"Built {built} AST cache file(s)")
+        return
+    
     if len(sys.argv) != 2:
         print("Usage: python music_dsl.py <input_file>")
+        print("       python music_dsl.py --build-cache <directory>")
         return
         
     input_file = sys.argv[1]
@@ -2278,24 +4945,26 @@ def main() -> None:
         with open(input_file, 'r') as f:
             source = f.read()
             
-        # Create lexer and tokenize the source
-        print("Tokenizing source code...")
-        lexer = Lexer(source)
-        tokens = lexer.scan_tokens()
-        
-        # Create parser and parse tokens into AST
-        print("Parsing tokens into AST...")
-        parser = Parser(tokens)
-        tracks = parser.parse()
+        # Use the precompiled AST if it was built from this exact source
+        cached_tracks = load_ast_cache(ast_cache_path(input_file), source)
+        if cached_tracks is not None:
+            print(f"Loaded precompiled AST from {ast_cache_path(input_file)}")
+            tracks = cached_tracks
+        else:
+            # Stream tokens from the lexer straight into the parser
+            print("Tokenizing and parsing source code...")
+            lexer = RegexLexer(source)
+            parser = Parser(lexer.iter_tokens())
+            tracks = parser.parse()
+            
+            if lexer.had_error or parser.had_error:
+                print("Parsing had errors but will continue with interpretation.")
         
         if not tracks:
             print("No valid tracks found in the input file.")
             return
         
         print(f"Successfully parsed {len(tracks)} tracks")
-            
-        if parser.had_error:
-            print("Parsing had errors but will continue with interpretation.")
         
         # Create interpreter and interpret AST
         print("Interpreting the music...")
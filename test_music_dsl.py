@@ -0,0 +1,596 @@
+# test_music_dsl.py - Regression tests for the Music DSL pipeline
+#
+# Usage: python -m pytest -q (with the packages in requirements-dev.txt)
+
+import contextlib
+import io
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+import wave
+from typing import Any, List, Tuple
+
+import numpy as np
+import pytest
+
+import music_dsl
+from music_dsl import (
+    Lexer, RegexLexer, Parser, IncrementalParser, Interpreter, build_ast_caches, ExecutionBudget,
+    BudgetExceededError, NoteRenderCache, StreamingEncoder, EncoderError, normalized_pcm_peak,
+    WAVETABLE_SIZE, additive_signal, wavetable_signal,
+)
+
+
+##############################
+# HELPERS
+##############################
+
+# Every way Interpreter can run a song; all must match the tree walker
+INTERPRETER_MODES = [
+    dict(compiled=False, optimize=False),
+    dict(compiled=False),
+    dict(optimize=False),
+    dict(replicate_loops=False),
+    dict(),
+]
+
+# Tempo and meter changes, variables, nested loops, sync blocks, every
+# instrument and a note spelling missing from NOTE_TO_MIDI
+RICH_SONG = """
+PianoTrack {
+    TimeSignature = 3/4;
+    Tempo = 100;
+    Volume = "mp";
+    base = 60;
+    for (i = 0; i < 4; i++) {
+        n = (base + i * 2);
+        Piano(R, n, 0.25);
+        sync {
+            Piano(L, C3, 0.5);
+            Piano(R, E4, 0.25);
+        }
+    }
+    Piano(R, E#4, 0.25);
+    Tempo = 140;
+    Volume = "f";
+    Pause(0.5);
+    for (j = 0; j < 3; j += 1) {
+        Piano(R, Bb4, 0.125);
+        Piano(R, F#5, 0.125);
+    }
+}
+GuitarTrack {
+    for (i = 0; i < 2; i++) {
+        for (f = 0; f < 4; f++) {
+            Guitar(2, f, 0.25);
+            sync {
+                Guitar(1, 0, 0.25);
+                Guitar(3, 2, 0.25);
+            }
+        }
+    }
+}
+BassTrack {
+    Volume = "ff";
+    root = 3;
+    for (i = 0; i < 4; i++) {
+        Bass(1, root, 0.5);
+        fifth = (root + 7);
+        Bass(1, fifth, 0.5);
+    }
+    root += 2;
+    Bass(2, root, 1);
+}
+DrumTrack {
+    for (i = 0; i < 4; i++) {
+        sync { Drum(KICK, 0.25); Drum(HIHAT_CLOSED, 0.25); }
+        Drum(HIHAT_CLOSED, 0.25);
+        sync { Drum(SNARE, 0.25); Drum(HIHAT_OPEN, 0.25); }
+        Drum(CRASH, 0.25);
+    }
+}
+"""
+
+# Long enough (36 s) to be cut into several render shards, with drums in every shard
+LONG_SONG = """
+PianoTrack {
+    for (i = 0; i < 48; i++) {
+        Piano(R, C4, 0.5);
+        Piano(R, G4, 0.25);
+    }
+}
+BassTrack {
+    for (i = 0; i < 36; i++) {
+        Bass(1, 3, 1);
+    }
+}
+DrumTrack {
+    for (i = 0; i < 36; i++) {
+        sync { Drum(KICK, 0.25); Drum(HIHAT_CLOSED, 0.25); }
+        Drum(HIHAT_CLOSED, 0.25);
+        sync { Drum(SNARE, 0.25); Drum(HIHAT_OPEN, 0.25); }
+        Drum(HIHAT_CLOSED, 0.25);
+    }
+}
+"""
+
+def read_song(name: str) -> str:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)) as f:
+        return f.read()
+
+
+SONGS = {
+    "rich": RICH_SONG,
+    "spacemusic": read_song("spacemusic.txt"),
+}
+
+def parse(source: str) -> List[Any]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Parser(RegexLexer(source).iter_tokens()).parse()
+
+
+def interpret(source: str, **options: Any) -> Interpreter:
+    tracks = parse(source)
+    interpreter = Interpreter(**options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter.interpret(tracks)
+    return interpreter
+
+
+def note_tuples(interpreter: Interpreter) -> List[Tuple[Any, ...]]:
+    events = interpreter.events
+    return [(e.start_time, e.duration, e.note_value, e.velocity, e.channel)
+            for e in events.events_at(events.note_indices())]
+
+
+def timeline(interpreter: Interpreter) -> Tuple[List[Tuple[Any, ...]], ...]:
+    """Notes, tempo changes and time signatures, as plain tuples"""
+    return (note_tuples(interpreter),
+            [(e.time, e.tempo) for e in interpreter.tempo_events],
+            [(e.time, e.numerator, e.denominator) for e in interpreter.time_signature_events])
+
+
+def render(interpreter: Interpreter, profile: Any = None, block_samples: int = 65536) -> np.ndarray:
+    return np.concatenate(list(interpreter.audio_blocks(block_samples, profile=profile)))
+
+
+##############################
+# LEXER
+##############################
+
+LEXER_EDGE_CASES = [
+    'x = 1.5; y = 20; z = "text";',
+    "Piano(R, C#4, 1); Piano(R, Bb3, 1); C4x = 1;",
+    "a != b; a >= b; a <= b; a < b; a > b; i++; i += 1;",
+    "// comment only\n\n// another\nPianoTrack {}",
+    'Volume = "unterminated\nPiano(R, C4, 1);',
+    "a ! b; $ @ ½ x;",
+    's = "two\nlines"; Tempo = 90;',
+]
+
+@pytest.mark.parametrize("source", list(SONGS.values()) + LEXER_EDGE_CASES)
+def test_regex_lexer_matches_lexer(source):
+    # Same tokens, and the same error messages
+    def scan(tokenize: Any) -> Tuple[List[Tuple[Any, ...]], str]:
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            scanned = [(t.type, t.lexeme, t.literal, t.line) for t in tokenize()]
+        return scanned, output.getvalue()
+
+    lexer = Lexer(source)
+    regex_lexer = RegexLexer(source)
+    assert scan(regex_lexer.iter_tokens) == scan(lexer.scan_tokens)
+    assert regex_lexer.had_error == lexer.had_error
+
+
+##############################
+# PARSER
+##############################
+
+def test_incremental_parser_reports_errors_per_call():
+    parser = IncrementalParser()
+    broken = "PianoTrack { Piano(R, C4, 1); Tempo = ; }"
+    clean = "PianoTrack { Piano(R, C4, 1); }"
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert parser.parse(broken)[1] is True
+        assert parser.parse(clean)[1] is False
+        # Cached chunks keep their status
+        tracks, had_error = parser.parse(broken)
+    assert had_error is True
+    assert parser.hits == 1
+    assert len(tracks) == 1
+
+
+@pytest.mark.parametrize("name", SONGS)
+def test_incremental_parser_matches_parser(name):
+    parser = IncrementalParser()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracks, had_error = parser.parse(SONGS[name])
+    assert not had_error
+    assert tracks == parse(SONGS[name])
+
+
+##############################
+# AST CACHE
+##############################
+
+@pytest.mark.parametrize("source", [
+    "PianoTrack { Piano(R, C4, 1); Piano(R, C4 1); }",  # note replaced by a placeholder
+    "PianoTrack { Piano(R, C4, 1); Tempo = ; }",  # command dropped
+    "PianoTrack { for (i = 0; i < 2; i += 1) { Tempo = ; } }",  # loop body command dropped
+    "PianoTrack { Piano(R, C4, 1); $ }",  # character skipped by the lexer
+])
+def test_build_ast_caches_skips_sources_with_errors(tmp_path, source):
+    (tmp_path / "song.txt").write_text(source)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert build_ast_caches(str(tmp_path)) == 0
+    assert not (tmp_path / "song.mdslc").exists()
+
+
+def test_build_ast_caches_caches_clean_sources(tmp_path):
+    (tmp_path / "song.txt").write_text("PianoTrack { Piano(R, C4, 1); }")
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert build_ast_caches(str(tmp_path)) == 1
+    assert (tmp_path / "song.mdslc").exists()
+
+
+##############################
+# INTERPRETER
+##############################
+
+UNKNOWN_SPELLING_SONG = "PianoTrack { Piano(R, E#4, 1); Piano(R, C4, 1); }"
+
+@pytest.mark.parametrize("options", INTERPRETER_MODES)
+def test_unknown_note_spelling_fails_only_its_command(options):
+    # E# is not in NOTE_TO_MIDI: that command errors, the C4 after it still plays
+    interpreter = interpret(UNKNOWN_SPELLING_SONG, **options)
+    assert note_tuples(interpreter) == [(0.0, 1.0, 60, 80, 0)]
+
+
+@pytest.mark.parametrize("options", INTERPRETER_MODES[1:])
+@pytest.mark.parametrize("name", SONGS)
+def test_interpreter_modes_match_tree_walker(name, options):
+    reference = interpret(SONGS[name], compiled=False, optimize=False)
+    assert timeline(interpret(SONGS[name], **options)) == timeline(reference)
+
+
+def test_iter_events_matches_sorted_interpret():
+    reference = interpret(RICH_SONG)
+    interpreter = Interpreter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        notes = [(e.start_time, e.duration, e.note_value, e.velocity, e.channel)
+                 for e in interpreter.iter_events(parse(RICH_SONG)) if hasattr(e, "note_value")]
+    assert notes == sorted(note_tuples(reference), key=lambda note: note[0])
+    assert timeline(interpreter)[1:] == timeline(reference)[1:]
+
+
+def test_interpret_parallel_matches_interpret():
+    interpreter = Interpreter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter.interpret_parallel(parse(RICH_SONG), max_workers=2)
+    assert timeline(interpreter) == timeline(interpret(RICH_SONG))
+
+
+##############################
+# EXECUTION BUDGET
+##############################
+
+# A billion notes per track: only the budget stops it
+RUNAWAY_SONG = """
+PianoTrack {
+    for (i = 0; i < 1000; i++) {
+        for (j = 0; j < 1000; j++) {
+            for (k = 0; k < 1000; k++) {
+                Piano(R, C4, 0.25);
+            }
+        }
+    }
+}
+BassTrack {
+    for (i = 0; i < 1000; i++) {
+        for (j = 0; j < 1000; j++) {
+            for (k = 0; k < 1000; k++) {
+                Bass(1, 3, 0.25);
+            }
+        }
+    }
+}
+"""
+
+BUDGET_LIMITS = [
+    ("commands", dict(max_commands=10_000)),
+    ("events", dict(max_events=5_000)),
+    ("seconds", dict(max_seconds=60)),
+    ("wall_seconds", dict(max_wall_seconds=0.2)),
+]
+
+def run_runaway_song(budget: ExecutionBudget, parallel: bool = False, **options: Any) -> BudgetExceededError:
+    interpreter = Interpreter(budget=budget, **options)
+    started = time.monotonic()
+    with pytest.raises(BudgetExceededError) as raised:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if parallel:
+                interpreter.interpret_parallel(parse(RUNAWAY_SONG), max_workers=2)
+            else:
+                interpreter.interpret(parse(RUNAWAY_SONG))
+    assert time.monotonic() - started < 10
+    return raised.value
+
+def assert_exceeded(error: BudgetExceededError, limit: str) -> None:
+    assert error.limit == limit
+    # Wall time is reported rounded to the millisecond
+    assert error.value >= error.maximum if limit == "wall_seconds" else error.value > error.maximum
+
+
+@pytest.mark.parametrize("options", INTERPRETER_MODES)
+@pytest.mark.parametrize("limit, limits", BUDGET_LIMITS)
+def test_budget_aborts_runaway_song(limit, limits, options):
+    error = run_runaway_song(ExecutionBudget(**limits), **options)
+    assert_exceeded(error, limit)
+
+
+@pytest.mark.parametrize("limit, limits", BUDGET_LIMITS)
+def test_budget_aborts_runaway_song_in_workers(limit, limits):
+    # The error is raised in a worker process and pickled back
+    error = run_runaway_song(ExecutionBudget(**limits), parallel=True)
+    assert_exceeded(error, limit)
+
+
+def test_budget_exceeded_error_pickles():
+    error = pickle.loads(pickle.dumps(BudgetExceededError("events", 5000, 5001)))
+    assert (error.limit, error.maximum, error.value) == ("events", 5000, 5001)
+    assert str(error) == "Execution budget exceeded: events reached 5001 (limit 5000)"
+
+
+def test_budget_exceeded_error_payload():
+    assert BudgetExceededError("commands", 10, 11).to_dict() == {
+        "error": "Execution budget exceeded: commands reached 11 (limit 10)",
+        "limit": "commands",
+        "maximum": 10,
+        "value": 11,
+    }
+
+
+def test_server_rejects_runaway_song(monkeypatch):
+    pytest.importorskip("flask")
+    pytest.importorskip("flask_cors")
+    from flask_server import app
+
+    monkeypatch.setitem(app.config, "DSL_MAX_COMMANDS", 10_000)
+    monkeypatch.setitem(app.config, "DSL_MAX_SECONDS", None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.test_client().post("/generate", json={"code": RUNAWAY_SONG})
+    assert response.status_code == 422
+    payload = response.get_json()
+    assert payload["limit"] == "commands"
+    assert payload["maximum"] == 10_000
+    assert payload["value"] > 10_000
+    assert payload["error"].startswith("Execution budget exceeded")
+    assert "session_id" in payload
+
+
+##############################
+# MIDI
+##############################
+
+@pytest.mark.parametrize("name", SONGS)
+def test_midi_writer_matches_midiutil(name):
+    pytest.importorskip("midiutil")
+    from bench_music_dsl import midiutil_bytes, decode_smf
+
+    interpreter = interpret(SONGS[name])
+    assert decode_smf(interpreter.midi_bytes()) == decode_smf(midiutil_bytes(interpreter))
+
+
+##############################
+# RENDERING
+##############################
+
+@pytest.fixture(scope="module")
+def rich_song() -> List[Any]:
+    return parse(RICH_SONG)
+
+
+def interpret_tracks(tracks: List[Any], **options: Any) -> Interpreter:
+    interpreter = Interpreter(**options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter.interpret(tracks)
+    return interpreter
+
+
+def test_peak_normalization_reaches_the_normalized_peak(rich_song):
+    interpreter = interpret_tracks(rich_song)
+    samples = render(interpreter)
+    assert len(samples) == interpreter.audio_sample_count()
+    assert np.abs(samples.astype(np.int32)).max() == normalized_pcm_peak()
+
+
+def test_limiter_stays_under_the_normalized_peak(rich_song):
+    peak = render(interpret_tracks(rich_song))
+    limited = render(interpret_tracks(rich_song, normalize="limiter"))
+    assert len(limited) == len(peak)
+    assert 0 < np.abs(limited.astype(np.int32)).max() <= normalized_pcm_peak()
+
+
+@pytest.mark.parametrize("normalize", ["peak", "limiter"])
+def test_rendering_does_not_depend_on_block_size(rich_song, normalize):
+    interpreter = interpret_tracks(rich_song, normalize=normalize)
+    assert np.array_equal(render(interpreter, block_samples=1000), render(interpreter))
+
+
+def test_note_cache_does_not_change_the_audio(rich_song):
+    uncached = interpret_tracks(rich_song, note_cache=NoteRenderCache(max_entries=0))
+    cached = interpret_tracks(rich_song)
+    assert np.array_equal(render(cached), render(uncached))
+    assert cached.note_cache.hits > 0
+
+
+def test_wavetable_synthesis_matches_additive(rich_song):
+    additive = render(interpret_tracks(rich_song)).astype(np.int32)
+    wavetable = render(interpret_tracks(rich_song, synthesis="wavetable")).astype(np.int32)
+    assert len(wavetable) == len(additive)
+    # Interpolation error stays below the int16 rounding of the mix
+    assert np.abs(wavetable - additive).max() <= 2
+
+
+@pytest.mark.parametrize("channel", range(4))
+@pytest.mark.parametrize("frequency", [41.2, 440.0, 3520.0])
+def test_wavetable_phase_wraps_on_long_notes(channel, frequency):
+    # Thousands of waveform cycles, and many times WAVETABLE_SIZE samples
+    duration = 3.0
+    sample_count = int(44100 * duration)
+    assert frequency * duration > 100 and sample_count > 10 * WAVETABLE_SIZE
+    t = np.linspace(0, duration, sample_count, endpoint=False)
+    signal = wavetable_signal(channel, frequency, duration, sample_count)
+    assert np.abs(signal - additive_signal(channel, frequency, t)).max() < 1e-5
+
+
+def test_note_cache_keys_include_the_sample_rate():
+    # The same note over the same samples is a different buffer at another rate
+    cache = NoteRenderCache()
+    cache.render(0, 60, 1.0, 80, 22050, "fundamental", 44100)
+    cache.render(0, 60, 1.0, 80, 22050, "fundamental", 22050)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+@pytest.mark.parametrize("normalize", ["peak", "limiter"])
+def test_sharded_rendering_matches_serial(normalize):
+    tracks = parse(LONG_SONG)
+    serial = interpret_tracks(tracks, normalize=normalize)
+    sharded = interpret_tracks(tracks, normalize=normalize, render_workers=2)
+    assert np.array_equal(render(sharded), render(serial))
+
+
+##############################
+# RENDER PROFILES
+##############################
+
+def wav_header(interpreter: Interpreter, profile: str) -> Tuple[int, int]:
+    output = io.BytesIO()
+    interpreter.synthesize_basic_wav(output, profile=profile)
+    output.seek(0)
+    with wave.open(output) as wav:
+        return wav.getframerate(), wav.getnframes()
+
+
+def test_preview_profile_halves_the_sample_rate(rich_song):
+    interpreter = interpret_tracks(rich_song)
+    final_rate, final_frames = wav_header(interpreter, "final")
+    preview_rate, preview_frames = wav_header(interpreter, "preview")
+    assert (final_rate, preview_rate) == (44100, 22050)
+    assert preview_frames == final_frames // 2
+    # A per-call profile leaves the interpreter's own profile alone
+    assert interpreter.profile.name == "final"
+
+
+def test_preview_profile_renders_fundamentals(rich_song):
+    preview = interpret_tracks(rich_song, profile="preview")
+    sine = interpret_tracks(rich_song, synthesis="fundamental")
+    assert np.array_equal(render(preview), render(sine, profile=preview.profile))
+
+
+def test_profiles_sharing_a_note_cache(rich_song):
+    shared = NoteRenderCache()
+    interpreter = interpret_tracks(rich_song, note_cache=shared)
+    for name in ("preview", "final", "preview"):
+        profile = interpreter.resolve_profile(name)
+        fresh = interpret_tracks(rich_song)
+        assert np.array_equal(render(interpreter, profile), render(fresh, profile))
+
+
+def test_unknown_profile_is_rejected(rich_song):
+    with pytest.raises(ValueError):
+        Interpreter(profile="draft")
+    with pytest.raises(ValueError):
+        interpret_tracks(rich_song).synthesize_basic_wav(io.BytesIO(), profile="draft")
+    # Unhashable names from JSON requests are unknown too, not a TypeError
+    with pytest.raises(ValueError):
+        Interpreter(profile=["final"])
+    with pytest.raises(ValueError):
+        interpret_tracks(rich_song).resolve_profile({"name": "final"})
+
+
+@pytest.mark.parametrize("profile", ["draft", ["final"], {"name": "final"}, None])
+def test_server_rejects_unknown_profiles(profile):
+    pytest.importorskip("flask")
+    pytest.importorskip("flask_cors")
+    from flask_server import app
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.test_client().post("/generate", json={"code": RICH_SONG, "profile": profile})
+    assert response.status_code == 400
+    assert response.get_json()["profiles"] == ["final", "preview"]
+
+
+##############################
+# STREAMING ENCODER
+##############################
+
+class FullDisk:
+    def write(self, data: bytes) -> None:
+        raise OSError(28, "No space left on device")
+
+
+@pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat as a stand-in encoder")
+def test_streaming_encoder_passes_blocks_through():
+    blocks = [np.arange(i, i + 3000, dtype=np.int16) for i in range(-30000, 30000, 3000)]
+    output = io.BytesIO()
+    with StreamingEncoder(output, ["cat"]) as encoder:
+        for block in blocks:
+            encoder.write(block)
+    assert output.getvalue() == b"".join(block.tobytes() for block in blocks)
+
+
+@pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat as a stand-in encoder")
+def test_streaming_encoder_reports_output_errors():
+    # The reader thread fails on the first chunk; writes must not block on the stalled encoder
+    block = np.zeros(65536, dtype=np.int16)
+    raised: List[Exception] = []
+
+    def encode() -> None:
+        try:
+            with StreamingEncoder(FullDisk(), ["cat"]) as encoder:
+                for _ in range(1000):
+                    encoder.write(block)
+        except EncoderError as e:
+            raised.append(e)
+
+    worker = threading.Thread(target=encode, daemon=True)
+    worker.start()
+    worker.join(30)
+    assert not worker.is_alive()
+    assert len(raised) == 1
+    assert isinstance(raised[0].__cause__, OSError)
+
+
+@pytest.mark.skipif(shutil.which("false") is None, reason="needs false as a failing encoder")
+def test_streaming_encoder_reports_encoder_failure():
+    with pytest.raises(EncoderError):
+        with StreamingEncoder(io.BytesIO(), ["false"]) as encoder:
+            for _ in range(100):
+                encoder.write(np.zeros(65536, dtype=np.int16))
+
+
+@pytest.mark.parametrize("pydub", ["missing", "export fails"])
+def test_wav_fallback_renders_the_song_once(rich_song, tmp_path, monkeypatch, pydub):
+    monkeypatch.setattr(music_dsl, "encoder_command", lambda *args: None)
+    if pydub == "missing":
+        monkeypatch.setitem(sys.modules, "pydub", None)
+    else:
+        def export(*args: Any, **kwargs: Any) -> None:
+            raise RuntimeError("no MP3 encoder")
+        monkeypatch.setattr(pytest.importorskip("pydub").AudioSegment, "export", export)
+    interpreter = interpret_tracks(rich_song)
+    renders = []
+    iter_audio_blocks = interpreter.iter_audio_blocks
+    monkeypatch.setattr(interpreter, "iter_audio_blocks",
+                        lambda *args: renders.append(args) or iter_audio_blocks(*args))
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter.convert_midi_to_mp3(None, str(tmp_path / "song.mp3"))
+    assert len(renders) == 1
+    # The fallback WAV is the plain, unmastered render
+    expected = io.BytesIO()
+    interpret_tracks(rich_song).synthesize_basic_wav(expected)
+    assert (tmp_path / "song.wav").read_bytes() == expected.getvalue()